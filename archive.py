@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+import zlib
+
+
+class LedgerArchive:
+    """Append-only compressed archive of old ledger rows, one file per month
+
+    ledger_YYYYMM.arc  - zlib-compressed blocks of rows, only ever appended
+    ledger_YYYYMM.idx  - JSON index: block offsets/sizes and block numbers per user_id
+    Rows are (id, user_id, game_type, amount, transaction_type, timestamp)"""
+
+    def __init__(self, directory, block_size=1000, level=9):
+        self.directory = directory
+        self.block_size = block_size
+        self.level = level
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def data_path(self, month):
+        return os.path.join(self.directory, f'ledger_{month}.arc')
+
+    def index_path(self, month):
+        return os.path.join(self.directory, f'ledger_{month}.idx')
+
+    def months(self):
+        """Archived months, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[len('ledger_'):-len('.idx')] for name in os.listdir(self.directory)
+                      if name.startswith('ledger_') and name.endswith('.idx'))
+
+    def _index(self, month):
+        index = self._indexes.get(month)
+        if index is None:
+            try:
+                with open(self.index_path(month), encoding='utf-8') as f:
+                    index = json.load(f)
+            except FileNotFoundError:
+                index = {'last_id': 0, 'rows': 0, 'blocks': [], 'users': {}}
+            self._indexes[month] = index
+        return index
+
+    def last_id(self, month):
+        """Biggest id already archived for month"""
+        with self._lock:
+            return self._index(month)['last_id']
+
+    def append(self, month, rows):
+        """Append rows (sorted by id) to month archive, rows already archived are skipped
+        Returns number of rows written"""
+        with self._lock:
+            index = self._index(month)
+            rows = [row for row in rows if row[0] > index['last_id']]
+            if not rows:
+                return 0
+
+            os.makedirs(self.directory, exist_ok=True)
+            blocks = []
+            with open(self.data_path(month), 'ab') as f:
+                for start in range(0, len(rows), self.block_size):
+                    block_rows = rows[start:start + self.block_size]
+                    payload = zlib.compress(
+                        json.dumps([list(row) for row in block_rows], default=str).encode('utf-8'),
+                        self.level)
+                    offset = f.tell()
+                    f.write(payload)
+                    blocks.append((offset, len(payload), block_rows))
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Новый индекс пишем только после того, как данные легли на диск
+            new_index = {
+                'last_id': rows[-1][0],
+                'rows': index['rows'] + len(rows),
+                'blocks': list(index['blocks']),
+                'users': {user: list(numbers) for user, numbers in index['users'].items()},
+            }
+            for offset, length, block_rows in blocks:
+                number = len(new_index['blocks'])
+                new_index['blocks'].append({
+                    'offset': offset,
+                    'length': length,
+                    'rows': len(block_rows),
+                    'min_id': block_rows[0][0],
+                    'max_id': block_rows[-1][0],
+                })
+                for user_id in {row[1] for row in block_rows}:
+                    new_index['users'].setdefault(str(user_id), []).append(number)
+
+            tmp_path = self.index_path(month) + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(new_index, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path(month))
+            self._indexes[month] = new_index
+            return len(rows)
+
+    def _read_blocks(self, month, numbers):
+        with self._lock:
+            index = self._index(month)
+            blocks = [index['blocks'][number] for number in numbers]
+        if not blocks:
+            return
+        with open(self.data_path(month), 'rb') as f:
+            for block in blocks:
+                f.seek(block['offset'])
+                for row in json.loads(zlib.decompress(f.read(block['length']))):
+                    yield tuple(row)
+
+    def read_user(self, month, user_id, before_id=None, limit=None):
+        """User rows from month archive, newest first"""
+        with self._lock:
+            index = self._index(month)
+            numbers = [number for number in index['users'].get(str(user_id), [])
+                       if before_id is None or index['blocks'][number]['min_id'] < before_id]
+
+        rows = []
+        # Идём с конца, чтобы для первой страницы хватило последних блоков
+        for number in reversed(numbers):
+            rows.extend(row for row in self._read_blocks(month, [number])
+                        if row[1] == user_id and (before_id is None or row[0] < before_id))
+            if limit is not None and len(rows) >= limit:
+                break
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return rows[:limit] if limit is not None else rows
+
+    def iter_rows(self, month):
+        """All rows of month archive, in id order"""
+        with self._lock:
+            count = len(self._index(month)['blocks'])
+        yield from self._read_blocks(month, range(count))
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+class BackupRestarted(Exception):
+    """Source database changed too often during step-by-step backup"""
+
+
+class BackupManager:
+    """Online snapshots of live database with SQLite backup API
+
+    Pages are copied in small steps with a pause between them, so the bot keeps
+    reading and writing. Every snapshot is checked with PRAGMA integrity_check
+    before it gets its final name: casino-YYYYMMDD-HHMMSS.db"""
+
+    def __init__(self, connect, directory='backups', prefix='casino', step_pages=256, step_sleep=0.01,
+                 max_restarts=5, keep_last=8, keep_days=7):
+        self.connect = connect
+        self.directory = directory
+        self.prefix = prefix
+        self.step_pages = step_pages
+        self.step_sleep = step_sleep
+        self.max_restarts = max_restarts
+        self.keep_last = keep_last
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+        self.backups = 0
+        self.failures = 0
+        self.pruned = 0
+        self.last = None
+
+    def snapshots(self):
+        """Snapshot paths, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if self._taken_at(name) is not None]
+
+    def _taken_at(self, name):
+        """Snapshot time from file name or None for foreign files"""
+        if not (name.startswith(f'{self.prefix}-') and name.endswith('.db')):
+            return None
+        try:
+            return datetime.strptime(name[len(self.prefix) + 1:-len('.db')], '%Y%m%d-%H%M%S')
+        except ValueError:
+            return None
+
+    def create(self):
+        """Take verified snapshot, returns its metrics (path, pages, bytes, seconds, ...)
+        Raises sqlite3.Error/OSError if backup or verification failed"""
+        with self._lock:
+            try:
+                report = self._create()
+            except (sqlite3.Error, OSError, BackupRestarted):
+                self.failures += 1
+                self._remove_partial()
+                raise
+            self.backups += 1
+            self.last = report
+            return report
+
+    def _create(self):
+        os.makedirs(self.directory, exist_ok=True)
+        moment = datetime.now()
+        path = os.path.join(self.directory, f"{self.prefix}-{moment.strftime('%Y%m%d-%H%M%S')}.db")
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        progress = {'steps': 0, 'restarts': 0, 'remaining': None, 'pages': 0}
+
+        def on_step(status, remaining, total):
+            progress['steps'] += 1
+            progress['pages'] = total
+            # Источник изменили другим соединением - SQLite начинает копирование заново,
+            # и шаг не продвигается дальше первых страниц
+            if progress['remaining'] is not None and remaining >= progress['remaining']:
+                progress['restarts'] += 1
+                if progress['restarts'] > self.max_restarts:
+                    raise BackupRestarted(f"backup restarted {progress['restarts']} times")
+            progress['remaining'] = remaining
+            # sleep= у backup() срабатывает только на занятой базе, паузу между шагами делаем сами
+            if remaining:
+                time.sleep(self.step_sleep)
+
+        started = time.perf_counter()
+        source = self.connect()
+        target = sqlite3.connect(tmp_path)
+        try:
+            try:
+                source.backup(target, pages=self.step_pages, progress=on_step, sleep=self.step_sleep)
+                mode = 'steps'
+            except BackupRestarted:
+                # Бот пишет слишком часто: копируем за один шаг из одного снимка.
+                # В WAL это держит только чтение и не мешает записи
+                source.backup(target, pages=-1)
+                mode = 'single_step'
+            copied = time.perf_counter()
+
+            # Снимок - обычный файл без -wal/-shm рядом
+            target.execute('PRAGMA journal_mode = DELETE').fetchall()
+            result = target.execute('PRAGMA integrity_check').fetchone()[0]
+            if result != 'ok':
+                raise sqlite3.DatabaseError(f"Backup integrity check failed: {result}")
+            pages = target.execute('PRAGMA page_count').fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+        verified = time.perf_counter()
+
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        seconds = verified - started
+        return {
+            'path': path,
+            'mode': mode,
+            'pages': pages,
+            'bytes': size,
+            'steps': progress['steps'],
+            'restarts': progress['restarts'],
+            'copy_seconds': copied - started,
+            'verify_seconds': verified - copied,
+            'seconds': seconds,
+            'mb_per_sec': size / 1048576 / (copied - started) if copied > started else 0,
+        }
+
+    def _remove_partial(self):
+        """Delete unfinished snapshot files left by failed backup"""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.startswith(f'{self.prefix}-') and '.db.tmp' in name:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def prune(self, now=None):
+        """Remove snapshots beyond keep_last newest that are older than keep_days
+        Returns removed paths"""
+        now = now or datetime.now()
+        cutoff = now - timedelta(days=self.keep_days)
+        removed = []
+        with self._lock:
+            snapshots = self.snapshots()
+            for path in snapshots[:max(len(snapshots) - self.keep_last, 0)]:
+                if self._taken_at(os.path.basename(path)) >= cutoff:
+                    continue
+                os.remove(path)
+                removed.append(path)
+            self.pruned += len(removed)
+        return removed
+
+    def stats(self):
+        """Backup counters and metrics of the last snapshot"""
+        with self._lock:
+            return {
+                'backups': self.backups,
+                'failures': self.failures,
+                'pruned': self.pruned,
+                'snapshots': len(self.snapshots()),
+                'last': dict(self.last) if self.last else None,
+            }
@@ -0,0 +1,410 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from database import Database, AsyncDatabase, PAYMENT_APPLIED, DEFAULT_TYPE_CODES, GAME_STATS_SCHEMA, LEDGER_COLUMNS, LEDGER_SCHEMA
+from wallet import WalletEngine
+
+# Прежняя схема: текстовое время и имена типов в каждой строке, game_stats с rowid
+TEXT_LEDGER_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        game_type TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        transaction_type TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+TEXT_GAME_STATS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        user_id INTEGER NOT NULL,
+        game_type TEXT NOT NULL,
+        games_played INTEGER DEFAULT 0 CHECK(games_played >= 0),
+        games_won INTEGER DEFAULT 0 CHECK(games_won >= 0),
+        total_bet INTEGER DEFAULT 0 CHECK(total_bet >= 0),
+        total_won INTEGER DEFAULT 0 CHECK(total_won >= 0),
+        PRIMARY KEY (user_id, game_type)
+    )
+'''
+
+
+def _ledger_rows(count, users, seed=1):
+    """Synthetic ledger rows (id, user_id, game_type, amount, transaction_type, timestamp)"""
+    rng = random.Random(seed)
+    games = DEFAULT_TYPE_CODES['game'][:4]
+    start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for row_id in range(1, count + 1):
+        yield (row_id, rng.randint(1, users), rng.choice(games), rng.randint(1, 1000),
+               rng.choice(('bet', 'win')), start + timedelta(seconds=rng.randint(0, 27 * 86400)))
+
+
+# Коды, которые получает свежая база (см. Database._schema_base)
+CODES = {kind: {name: code for code, name in enumerate(names, 1)}
+         for kind, names in DEFAULT_TYPE_CODES.items()}
+
+
+def _compact(row):
+    row_id, user_id, game_type, amount, transaction_type, timestamp = row
+    return (row_id, user_id, CODES['game'][game_type], amount,
+            CODES['transaction'][transaction_type], int(timestamp.timestamp()))
+
+
+def _run_layout(path, ledger_schema, stats_schema, rows, batch_size, convert):
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(ledger_schema.format(name='ledger'))
+    conn.execute('CREATE INDEX idx_ledger_user_id ON ledger(user_id, id, game_type, amount, transaction_type, timestamp)')
+    conn.execute('CREATE INDEX idx_ledger_time ON ledger(timestamp)')
+    conn.execute(stats_schema.format(name='game_stats'))
+    conn.commit()
+
+    ledger_seconds = 0.0
+    stats_seconds = 0.0
+    for start in range(0, len(rows), batch_size):
+        batch = [convert(row) for row in rows[start:start + batch_size]]
+
+        started = time.perf_counter()
+        conn.executemany(f'INSERT INTO ledger ({LEDGER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)', batch)
+        conn.commit()
+        ledger_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        conn.executemany('''
+            INSERT INTO game_stats (user_id, game_type, games_played, games_won, total_bet, total_won)
+            VALUES (?, ?, 1, 0, ?, 0)
+            ON CONFLICT(user_id, game_type) DO UPDATE SET
+                games_played = games_played + 1,
+                total_bet = total_bet + excluded.total_bet
+        ''', [(row[1], row[2], row[3]) for row in batch])
+        conn.commit()
+        stats_seconds += time.perf_counter() - started
+
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    pages = dict(conn.execute("SELECT name, SUM(pgsize) / ? FROM dbstat GROUP BY name", (page_size,))) \
+        if _has_dbstat(conn) else {}
+    conn.close()
+    return {
+        'file_bytes': os.path.getsize(path),
+        'ledger_rows_per_sec': len(rows) / ledger_seconds if ledger_seconds else 0,
+        'stats_upserts_per_sec': len(rows) / stats_seconds if stats_seconds else 0,
+        'pages': pages,
+    }
+
+
+def _has_dbstat(conn):
+    try:
+        conn.execute('SELECT 1 FROM dbstat LIMIT 1').fetchall()
+        return True
+    except sqlite3.Error:
+        return False
+
+
+def bench_storage(rows=200000, users=10000, batch_size=1000):
+    """Old text layout vs compact layout: file size and insert rate"""
+    data = list(_ledger_rows(rows, users))
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        results['text'] = _run_layout(os.path.join(directory, 'text.db'), TEXT_LEDGER_SCHEMA,
+                                      TEXT_GAME_STATS_SCHEMA, data, batch_size, tuple)
+        results['compact'] = _run_layout(os.path.join(directory, 'compact.db'), LEDGER_SCHEMA,
+                                         GAME_STATS_SCHEMA, data, batch_size, _compact)
+    return results
+
+
+def storage(args):
+    """Размер файла и скорость вставки: прежняя текстовая схема против компактной"""
+    results = bench_storage(args.rows, args.users, args.batch_size)
+    print(f"{'схема':<8} {'размер, МБ':>11} {'журнал, строк/с':>16} {'game_stats, upsert/с':>21}")
+    for layout, result in results.items():
+        print(f"{layout:<8} {result['file_bytes'] / 1048576:>11.2f} "
+              f"{result['ledger_rows_per_sec']:>16.0f} {result['stats_upserts_per_sec']:>21.0f}")
+        for name, pages in sorted(result['pages'].items()):
+            print(f"         {name:<30} {pages} стр.")
+    text, compact = results['text'], results['compact']
+    print(f"Компактная схема: размер x{compact['file_bytes'] / text['file_bytes']:.2f}, "
+          f"вставка x{compact['ledger_rows_per_sec'] / text['ledger_rows_per_sec']:.2f}")
+
+
+def _stress_worker(path, users, rounds, seed, results, finished, cache_ttl):
+    """One bot process: random roulette/poker rounds against shared users
+    When all processes are done, reports balances it shows to players"""
+    db = Database(path, ban_refresh_interval=0, partition_check_interval=0, balance_cache_ttl=cache_ttl)
+    rng = random.Random(seed)
+    settled = 0
+    for _ in range(rounds):
+        user_id = rng.randint(1, users)
+        bet = rng.randint(1, 50)
+        win = rng.choice((0, 0, bet * 2, bet * 3))
+        if rng.random() < 0.5:
+            if db.settle_round(user_id, "roulette", bet, win, win > 0) is not None:
+                settled += 1
+        elif db.place_bet(user_id, "poker", bet) is not None:
+            # Многошаговая игра: ставка списана, расчёт отдельной транзакцией
+            if db.settle_round(user_id, "poker", bet, win, win > 0, bet_placed=True) is not None:
+                settled += 1
+    results.put((settled, db.get_write_stats()))
+    # Кэш балансов не должен показывать устаревшее дольше cache_ttl после чужих изменений
+    finished.wait()
+    time.sleep(cache_ttl)
+    results.put({user_id: db.get_balance(user_id) for user_id in range(1, users + 1)})
+    db.close()
+
+
+def bench_stress(processes=4, users=20, rounds=500, start_balance=100000, cache_ttl=0.2):
+    """Several processes hammer the same users; balances must reconcile with the ledger exactly
+    and every process must show the stored balance once its cache entries expire"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'stress.db')
+        db = Database(path, ban_refresh_interval=0, partition_check_interval=0)
+        for user_id in range(1, users + 1):
+            db.add_user(user_id, f"stress{user_id}", start_balance)
+        db.close()
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        finished = context.Event()
+        workers = [context.Process(target=_stress_worker,
+                                   args=(path, users, rounds, seed, results, finished, cache_ttl))
+                   for seed in range(processes)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        reports = [results.get() for _ in workers]
+        elapsed = time.perf_counter() - started
+        finished.set()
+        shown = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        conn = sqlite3.connect(path)
+        balances = dict(conn.execute('SELECT user_id, balance FROM users'))
+        ledger = dict(conn.execute('''
+            SELECT t.user_id, SUM(CASE k.name WHEN 'win' THEN t.amount WHEN 'bet' THEN -t.amount ELSE 0 END)
+            FROM transactions t
+            JOIN type_codes k ON k.kind = 'transaction' AND k.code = t.transaction_type
+            GROUP BY t.user_id
+        '''))
+        games_played = conn.execute('SELECT COALESCE(SUM(games_played), 0) FROM game_stats').fetchone()[0]
+        conn.close()
+
+    mismatched = {user_id: (balance, start_balance + ledger.get(user_id, 0))
+                  for user_id, balance in balances.items()
+                  if balance != start_balance + ledger.get(user_id, 0)}
+    stale = {user_id: (balances[user_id], [process[user_id] for process in shown])
+             for user_id in balances if any(process[user_id] != balances[user_id] for process in shown)}
+    totals = {}
+    for _, stats in reports:
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+    settled = sum(count for count, _ in reports)
+    return {
+        'seconds': elapsed,
+        'rounds_per_sec': settled / elapsed if elapsed else 0,
+        'settled': settled,
+        'games_played': games_played,
+        'write_stats': totals,
+        'mismatched': mismatched,
+        'stale': stale,
+    }
+
+
+def stress(args):
+    """Несколько процессов бота на одной базе: балансы должны сойтись с журналом до звезды"""
+    result = bench_stress(args.processes, args.users, args.rounds)
+    print(f"Процессов: {args.processes}, игроков: {args.users}, раундов сыграно: {result['settled']} "
+          f"за {result['seconds']:.1f} с ({result['rounds_per_sec']:.0f} раундов/с)")
+    print(f"Транзакции записи: {result['write_stats']}")
+    if result['mismatched'] or result['stale'] or result['games_played'] != result['settled']:
+        print(f"❌ Расхождения: балансы {result['mismatched']}, устаревший кэш {result['stale']}, "
+              f"game_stats {result['games_played']} против {result['settled']} раундов")
+        raise SystemExit(1)
+    print("✅ Балансы всех игроков сходятся с журналом транзакций")
+
+
+def _replay_worker(path, payments, copies, results):
+    """One bot process: every payment update delivered copies times at once"""
+    async def deliver():
+        db = AsyncDatabase(Database(path, ban_refresh_interval=0, partition_check_interval=0),
+                           workers=8, read_workers=4)
+        calls = [db.record_payment(charge_id, user_id, amount, f"stars_{amount}_{user_id}")
+                 for charge_id, user_id, amount in payments for _ in range(copies)]
+        random.shuffle(calls)
+        statuses = await asyncio.gather(*calls)
+        db.close()
+        return sum(1 for status, _ in statuses if status == PAYMENT_APPLIED)
+
+    results.put(asyncio.run(deliver()))
+
+
+def bench_replay(processes=2, payments=50, copies=20, users=5, start_balance=1000):
+    """Redelivered payment updates, concurrently from several processes: each charge is credited once"""
+    rng = random.Random(1)
+    charges = [(f"charge_{number}", rng.randint(1, users), rng.choice((50, 100, 500)))
+               for number in range(payments)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'replay.db')
+        db = Database(path, ban_refresh_interval=0, partition_check_interval=0)
+        for user_id in range(1, users + 1):
+            db.add_user(user_id, f"payer{user_id}", start_balance)
+        db.close()
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        workers = [context.Process(target=_replay_worker, args=(path, charges, copies, results))
+                   for _ in range(processes)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        applied = sum(results.get() for _ in workers)
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        conn = sqlite3.connect(path)
+        balances = dict(conn.execute('SELECT user_id, balance FROM users'))
+        payment_rows = conn.execute('SELECT COUNT(*) FROM payments').fetchone()[0]
+        ledger_rows = conn.execute('''
+            SELECT COUNT(*) FROM transactions t
+            JOIN type_codes k ON k.kind = 'transaction' AND k.code = t.transaction_type
+            WHERE k.name = 'buy_stars'
+        ''').fetchone()[0]
+        conn.close()
+
+    expected = {user_id: start_balance for user_id in range(1, users + 1)}
+    for _, user_id, amount in charges:
+        expected[user_id] += amount
+    return {
+        'deliveries': processes * payments * copies,
+        'seconds': elapsed,
+        'applied': applied,
+        'payments': payments,
+        'payment_rows': payment_rows,
+        'ledger_rows': ledger_rows,
+        'mismatched': {user_id: (balances.get(user_id), balance)
+                       for user_id, balance in expected.items() if balances.get(user_id) != balance},
+    }
+
+
+def replay(args):
+    """Повторная доставка одних и тех же платежей: каждый должен зачислиться ровно один раз"""
+    result = bench_replay(args.processes, args.payments, args.copies)
+    print(f"Доставок: {result['deliveries']} за {result['seconds']:.1f} с, "
+          f"зачислено: {result['applied']} из {result['payments']} платежей")
+    if (result['mismatched'] or result['applied'] != result['payments']
+            or result['payment_rows'] != result['payments'] or result['ledger_rows'] != result['payments']):
+        print(f"❌ Двойное зачисление: {result}")
+        raise SystemExit(1)
+    print("✅ Каждый платёж зачислен ровно один раз")
+
+
+def _place_bets(db, bets):
+    started = time.perf_counter()
+    placed = sum(1 for user_id, bet in bets if db.place_bet(user_id, "roulette", bet) is not None)
+    return placed, time.perf_counter() - started
+
+
+def bench_wallet(rounds=20000, users=1000, start_balance=100000, ledger_batch_size=200):
+    """Bets/sec: balances in SQLite vs in-memory wallet, plus wallet recovery time"""
+    rng = random.Random(1)
+    bets = [(rng.randint(1, users), rng.randint(1, 100)) for _ in range(rounds)]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        balances = {}
+        for mode in ('sqlite', 'wallet'):
+            path = os.path.join(directory, f'{mode}.db')
+            wallet = WalletEngine(os.path.join(directory, 'wallet')) if mode == 'wallet' else None
+            db = Database(path, ban_refresh_interval=0, partition_check_interval=0,
+                          ledger_batch_size=ledger_batch_size, wallet=wallet)
+            for user_id in range(1, users + 1):
+                db.add_user(user_id, f"bettor{user_id}", start_balance)
+            placed, seconds = _place_bets(db, bets)
+            db.close()
+            conn = sqlite3.connect(path)
+            balances[mode] = dict(conn.execute('SELECT user_id, balance FROM users'))
+            conn.close()
+            results[mode] = {'bets_per_sec': placed / seconds if seconds else 0, 'placed': placed}
+
+        # Голый движок без SQLite и журнала транзакций
+        engine = WalletEngine(os.path.join(directory, 'engine'), snapshot_interval=0, snapshot_records=0)
+        for user_id in range(1, users + 1):
+            engine.create(user_id, start_balance)
+        started = time.perf_counter()
+        for user_id, bet in bets:
+            engine.apply(user_id, -bet)
+        seconds = time.perf_counter() - started
+        expected = dict(engine.balances)
+        # Остановка без снимка: при старте весь журнал проигрывается заново
+        engine.close(snapshot=False)
+        recovered = WalletEngine(os.path.join(directory, 'engine'))
+        results['engine'] = {'bets_per_sec': rounds / seconds if seconds else 0,
+                             'replay_seconds': recovered.stats()['recovery_seconds'],
+                             'replayed_records': recovered.stats()['recovered_records'],
+                             'recovered_ok': recovered.balances == expected}
+        recovered.close()
+        recovered = WalletEngine(os.path.join(directory, 'engine'))
+        results['engine']['snapshot_load_seconds'] = recovered.stats()['recovery_seconds']
+        recovered.close()
+
+    results['same_balances'] = balances['sqlite'] == balances['wallet']
+    return results
+
+
+def wallet(args):
+    """Ставки в секунду: балансы в SQLite против кошелька в памяти с журналом"""
+    results = bench_wallet(args.rounds, args.users)
+    sqlite_rate = results['sqlite']['bets_per_sec']
+    for mode in ('sqlite', 'wallet', 'engine'):
+        rate = results[mode]['bets_per_sec']
+        print(f"{mode:<8} {rate:>10.0f} ставок/с  x{rate / sqlite_rate:.1f}")
+    engine = results['engine']
+    print(f"Восстановление: журнал {engine['replayed_records']} записей за {engine['replay_seconds'] * 1000:.0f} мс, "
+          f"снимок за {engine['snapshot_load_seconds'] * 1000:.0f} мс")
+    if not results['same_balances'] or not engine['recovered_ok']:
+        print(f"❌ Балансы разошлись: {results}")
+        raise SystemExit(1)
+    print("✅ Балансы в SQLite и в кошельке совпадают, журнал восстанавливается без потерь")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности базы данных казино")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    layout = commands.add_parser("storage", help="размер и скорость вставки: текстовая и компактная схема")
+    layout.add_argument("--rows", type=int, default=200000)
+    layout.add_argument("--users", type=int, default=10000)
+    layout.add_argument("--batch-size", type=int, default=1000)
+    layout.set_defaults(handler=storage)
+
+    hammer = commands.add_parser("stress", help="несколько процессов на одних и тех же игроках")
+    hammer.add_argument("--processes", type=int, default=4)
+    hammer.add_argument("--users", type=int, default=20)
+    hammer.add_argument("--rounds", type=int, default=500, help="раундов на процесс")
+    hammer.set_defaults(handler=stress)
+
+    redeliver = commands.add_parser("replay", help="повторная доставка платежей из нескольких процессов")
+    redeliver.add_argument("--processes", type=int, default=2)
+    redeliver.add_argument("--payments", type=int, default=50)
+    redeliver.add_argument("--copies", type=int, default=20, help="сколько раз доставить каждый платёж")
+    redeliver.set_defaults(handler=replay)
+
+    engine = commands.add_parser("wallet", help="ставки в секунду: SQLite против кошелька в памяти")
+    engine.add_argument("--rounds", type=int, default=20000)
+    engine.add_argument("--users", type=int, default=1000)
+    engine.set_defaults(handler=wallet)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
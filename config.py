@@ -14,6 +14,80 @@ if not BOT_TOKEN:
 # Другие настройки
 DATABASE_NAME = "casino.db"
 START_BALANCE = 1000
+HISTORY_PAGE_SIZE = 10
+LEADERBOARD_SIZE = 10
+
+# Пул соединений с базой данных
+DB_POOL_SIZE = 5             # максимум соединений для чтения (писатель всегда один)
+DB_POOL_MAX_LIFETIME = 3600  # время жизни соединения в секундах
+
+# Профиль производительности SQLite: default, safe, balanced, fast
+DB_PROFILE = "balanced"
+
+# Потоки для запросов к базе из асинхронных обработчиков
+DB_WORKERS = 4
+DB_READ_WORKERS = 4          # отдельные потоки для чтений, чтобы они не ждали записи
+DB_MAX_PENDING = 1000        # максимум запросов в работе одновременно, остальные ждут
+
+# Повторы транзакции записи при конфликте версий или занятой базе (несколько процессов бота)
+DB_WRITE_RETRIES = 8
+DB_WRITE_BACKOFF_MS = 5          # первая пауза, дальше удваивается (не больше 0.5 с)
+
+# Отложенная запись журнала транзакций пачками (0 - писать каждую строку сразу)
+LEDGER_BATCH_SIZE = 200
+LEDGER_FLUSH_INTERVAL_MS = 200   # максимальное окно потери журнала при сбое
+LEDGER_MAX_PENDING = 2000        # больше строк в буфере - пишущий поток сбрасывает их сам
+
+# Отложенная запись game_stats суммами по игроку и игре (0 - писать в транзакции раунда)
+GAME_STATS_BATCH_SIZE = 500      # сбросить раньше, если накопилось столько пар игрок/игра
+GAME_STATS_FLUSH_INTERVAL_MS = 1000
+
+# Кэш балансов в памяти (выключите для отладки)
+BALANCE_CACHE_ENABLED = True
+BALANCE_CACHE_SIZE = 10000
+BALANCE_CACHE_TTL = 2            # секунд: столько баланс может отставать от изменений другого процесса бота
+
+# Число полос блокировок по user_id: операции с балансом одного игрока идут по очереди.
+# Коммиты SQLite всех игроков всё равно проходят по одному (одно соединение писателя)
+BALANCE_LOCK_STRIPES = 64
+
+# last_active копится в памяти и пишется одним UPDATE (секунды, 0 - только при остановке)
+ACTIVITY_FLUSH_INTERVAL = 5
+
+# Как часто перечитывать список забаненных из базы (секунды)
+BAN_REFRESH_INTERVAL = 60
+
+# Сжатый архив старых транзакций
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_DAYS = 90          # месяцы старше этого уходят в архив целиком
+ARCHIVE_INTERVAL = 86400         # как часто запускать архивацию (0 - только вручную)
+
+# Резервные копии базы на лету (SQLite backup API)
+BACKUP_DIR = "backups"
+BACKUP_INTERVAL = 21600          # как часто делать снимок в секундах (0 - только вручную)
+BACKUP_KEEP_LAST = 8             # последние снимки не удаляются никогда
+BACKUP_KEEP_DAYS = 7             # более старые снимки удаляются, если вышли за KEEP_LAST
+BACKUP_STEP_PAGES = 256          # страниц за один шаг копирования
+BACKUP_STEP_SLEEP_MS = 10        # пауза между шагами, чтобы не мешать боту
+
+# Сверка балансов с журналом транзакций в фоне (проверяются только новые строки журнала)
+RECONCILE_INTERVAL = 300         # как часто запускать сверку в секундах (0 - только вручную)
+RECONCILE_CHUNK_SIZE = 5000      # строк журнала за один шаг
+RECONCILE_DUTY_CYCLE = 0.1       # доля времени, которую сверка работает, остальное - паузы
+RECONCILE_SETTLE = 30            # счёт сверяется, когда игрок не играл столько секунд
+
+# Балансы в памяти с журналом изменений и снимками (wallet.py) вместо users.balance.
+# Только для одного процесса бота: другие процессы не увидят балансы кошелька
+WALLET_ENABLED = False
+WALLET_DIR = "wallet"
+WALLET_FSYNC_INTERVAL_MS = 50    # окно потери изменений при сбое (0 - fsync на каждое изменение)
+WALLET_SNAPSHOT_INTERVAL = 300   # как часто делать снимок балансов в секундах
+WALLET_SNAPSHOT_RECORDS = 1000000  # или после стольких записей журнала
+WALLET_SYNC_INTERVAL = 5         # как часто переносить изменённые балансы в users (секунды)
+
+# Переносы данных после миграций схемы идут в фоне короткими транзакциями
+SCHEMA_BACKFILL_CHUNK = 2000     # строк журнала за одну транзакцию
+SCHEMA_BACKFILL_PAUSE_MS = 20    # пауза между транзакциями, чтобы не мешать боту
 
 # Проверка, что токен действителен (базовая проверка)
 if not BOT_TOKEN.startswith(("5", "6")):
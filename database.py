@@ -1,227 +1,2648 @@
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import asyncio
+import atexit
+import functools
+import os
+import random
 import threading
+import queue
+import time
 
 from telegram import User
 
+from archive import LedgerArchive
+from backup import BackupManager
+from leaderboard import Leaderboard, OVERALL
+
+
+# Профили производительности SQLite (применяются к каждому новому соединению)
+PRAGMA_PROFILES = {
+    # Поведение SQLite по умолчанию
+    'default': {},
+    # WAL, но с fsync на каждый коммит
+    'safe': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -8000,
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+    },
+    # WAL + synchronous=NORMAL: коммит без fsync, данные не теряются при падении процесса
+    'balanced': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -32000,
+        'mmap_size': 134217728,
+        'temp_store': 'MEMORY',
+    },
+    # Максимальная скорость, возможна потеря последних коммитов при сбое ОС
+    'fast': {
+        'busy_timeout': 10000,
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+}
+
+REPORTED_PRAGMAS = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store', 'busy_timeout')
+
+SYNCHRONOUS_NAMES = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+TEMP_STORE_NAMES = {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'}
+
+# Защита от переполнения баланса
+MAX_BALANCE = 100000000
+
+# Колонки журнала транзакций (одинаковые во всех месячных партициях)
+LEDGER_COLUMNS = 'id, user_id, game_type, amount, transaction_type, timestamp'
+
+# Компактная схема: время хранится целыми секундами epoch, игры и типы транзакций -
+# маленькими кодами из справочника type_codes. Снаружи Database отдаёт имена и текстовое время
+TYPE_KINDS = {'game': 'game_type', 'transaction': 'transaction_type'}
+DEFAULT_TYPE_CODES = {
+    'game': ('roulette', 'blackjack', 'poker', 'chess', 'purchase'),
+    'transaction': ('bet', 'win', 'buy_stars'),
+}
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+USERS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        balance INTEGER DEFAULT 0 CHECK(balance >= 0),
+        created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        last_active INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        is_banned INTEGER DEFAULT 0,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+'''
+
+# Составной первичный ключ - строки лежат прямо в B-дереве ключа, без отдельного rowid
+GAME_STATS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        user_id INTEGER NOT NULL,
+        game_type INTEGER NOT NULL,
+        games_played INTEGER DEFAULT 0 CHECK(games_played >= 0),
+        games_won INTEGER DEFAULT 0 CHECK(games_won >= 0),
+        total_bet INTEGER DEFAULT 0 CHECK(total_bet >= 0),
+        total_won INTEGER DEFAULT 0 CHECK(total_won >= 0),
+        PRIMARY KEY (user_id, game_type),
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    ) WITHOUT ROWID
+'''
+
+LEDGER_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        game_type INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        transaction_type INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )
+'''
+
+# Результат Database.record_payment
+PAYMENT_APPLIED = 'applied'
+PAYMENT_DUPLICATE = 'already_applied'
+PAYMENT_REJECTED = 'rejected'          # баланс вышел бы за MAX_BALANCE
+PAYMENT_UNKNOWN_USER = 'unknown_user'
+PAYMENT_FAILED = 'failed'              # ошибка базы, платёж не записан
+
+# Типы транзакций, которые списывают сумму с баланса (остальные зачисляют)
+DEBIT_TRANSACTION_TYPES = ('bet',)
+
+# Верхняя граница паузы между повторами записи (секунды)
+WRITE_BACKOFF_CAP = 0.5
+
+# Текстовое время старой схемы (локальное) -> epoch
+TEXT_TO_EPOCH = "CAST(strftime('%s', {column}, 'utc') AS INTEGER)"
+
+# Сводные таблицы по транзакциям: таблица -> формат периода
+ROLLUP_PERIODS = {
+    'hour': ('rollup_hourly', '%Y-%m-%d %H:00'),
+    'day': ('rollup_daily', '%Y-%m-%d'),
+}
+
+# Миграции схемы по порядку (методы Database); PRAGMA user_version - сколько из них применено.
+# Новая миграция только дописывается в конец
+SCHEMA_MIGRATIONS = (
+    '_schema_base',
+    '_schema_row_versions',
+    '_schema_payments',
+    '_schema_reconcile',
+    '_schema_wallet',
+)
+
+# Фоновые переносы данных, которые назначают миграции: имя -> метод (conn, после id, до id включительно)
+SCHEMA_BACKFILLS = {
+    'rollups': '_add_rollups',
+}
+
+
+class VersionConflict(sqlite3.OperationalError):
+    """Balance row was changed by another writer since it was read"""
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived connections with checkout/return"""
+
+    def __init__(self, factory, size=5, max_lifetime=3600, timeout=30):
+        self.factory = factory
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def _open(self):
+        """Open new connection for the pool"""
+        try:
+            return self.factory(), time.monotonic()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _is_healthy(self, conn, born):
+        """Check connection lifetime and that it still answers"""
+        if self.max_lifetime and time.monotonic() - born > self.max_lifetime:
+            return False
+        try:
+            conn.execute('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        """Close connection and free its slot"""
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+            self.discarded += 1
+
+    def acquire(self):
+        """Checkout connection: reuse idle one or open new while pool not full"""
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed")
+
+        while True:
+            try:
+                conn, born = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if self._is_healthy(conn, born):
+                with self._lock:
+                    self.hits += 1
+                return conn, born
+            self._discard(conn)
+
+        with self._lock:
+            can_open = self._created < self.size
+            if can_open:
+                self._created += 1
+                self.misses += 1
+        if can_open:
+            return self._open()
+
+        # Пул исчерпан - ждём возврата соединения
+        try:
+            conn, born = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Connection pool exhausted")
+        if self._is_healthy(conn, born):
+            with self._lock:
+                self.hits += 1
+            return conn, born
+        self._discard(conn)
+        with self._lock:
+            self._created += 1
+            self.misses += 1
+        return self._open()
+
+    def release(self, conn, born):
+        """Return connection to the pool"""
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            self._discard(conn)
+            return
+        self._idle.put((conn, born))
+
+    @contextmanager
+    def connection(self):
+        """Checkout connection for the duration of with-block"""
+        conn, born = self.acquire()
+        try:
+            yield conn
+        except sqlite3.DatabaseError as e:
+            # Сломанное соединение не возвращаем в пул
+            if not isinstance(e, (sqlite3.OperationalError, sqlite3.IntegrityError)):
+                self._discard(conn)
+                raise
+            self.release(conn, born)
+            raise
+        except BaseException:
+            self.release(conn, born)
+            raise
+        else:
+            self.release(conn, born)
+
+    def stats(self):
+        """Pool counters"""
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._created,
+                'idle': self._idle.qsize(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'discarded': self.discarded,
+            }
+
+    def close(self):
+        """Close all idle connections"""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+class BalanceCache:
+    """LRU cache of balances keyed by user_id
+    Keeps row version next to the balance for compare-and-swap updates.
+    Entries expire after ttl seconds: other bot processes change rows behind this cache"""
+
+    def __init__(self, max_size=10000, enabled=True, ttl=2.0):
+        self.max_size = max_size
+        self.enabled = enabled
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        # Растёт при каждой записи, чтобы читатели без блокировки не положили устаревший баланс
+        self._generation = 0
+        # Номер последней записи каждого игрока: прочитанный из базы баланс кладётся в кэш,
+        # если писали только других игроков. _floor - номер, раньше которого записи забыты
+        self._written = {}
+        self._floor = 0
+
+    def get(self, user_id):
+        """Cached balance or None"""
+        entry = self.get_entry(user_id)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, user_id):
+        """Cached (balance, version) or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None and self.ttl and time.monotonic() - entry[2] >= self.ttl:
+                # Строку мог изменить другой процесс бота - перечитаем из базы
+                del self._data[user_id]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return entry[:2]
+
+    def set(self, user_id, balance, version):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._mark_written(user_id)
+            self._put(user_id, (balance, version))
+
+    def _mark_written(self, user_id):
+        self._generation += 1
+        self._written[user_id] = self._generation
+        if len(self._written) > self.max_size * 2:
+            self._written.clear()
+            self._floor = self._generation
+
+    def generation(self):
+        """Write counter to pass to fill"""
+        with self._lock:
+            return self._generation
+
+    def fill(self, user_id, balance, version, generation):
+        """Cache balance read from database unless this user was written since generation"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if max(self._written.get(user_id, 0), self._floor) <= generation:
+                self._put(user_id, (balance, version))
+
+    def _put(self, user_id, entry):
+        self._data[user_id] = entry + (time.monotonic(),)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._mark_written(user_id)
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._written.clear()
+            self._floor = self._generation
+            self._data.clear()
+
+    def stats(self):
+        """Hit-rate counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'evictions': self.evictions,
+                'expired': self.expired,
+                'ttl': self.ttl,
+            }
+
+
+class ActivityTracker:
+    """Last activity time per user waiting to be written to users.last_active
+    Many touches of one user between flushes become one UPDATE"""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.touches = 0
+        self.flushes = 0
+        self.written = 0
+
+    def touch(self, user_id):
+        with self._lock:
+            self._pending[user_id] = int(time.time())
+            self.touches += 1
+
+    def is_pending(self, user_id):
+        """Activity not yet written to database"""
+        with self._lock:
+            return user_id in self._pending
+
+    def drain(self):
+        """Pending activity [(last_active, user_id), ...], tracker is emptied"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            return [(moment, user_id) for user_id, moment in pending.items()]
+
+    def restore(self, rows):
+        """Put back rows whose write failed, newer touches win"""
+        with self._lock:
+            for moment, user_id in rows:
+                self._pending[user_id] = max(moment, self._pending.get(user_id, 0))
+
+    def flushed(self, count):
+        with self._lock:
+            self.flushes += 1
+            self.written += count
+
+    def stats(self):
+        """Touches vs rows actually written"""
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'touches': self.touches,
+                'flushes': self.flushes,
+                'written': self.written,
+                'coalesced': self.touches - self.written - len(self._pending),
+            }
+
+
+class StripedLock:
+    """Fixed set of locks picked by key (user_id)
+    Serializes read-modify-write of one user (balance check, cache, wallet, buffered rows).
+    Different users don't wait on each other's stripe, but their SQLite commits
+    still go one by one under Database.write_lock"""
+
+    def __init__(self, stripes=64):
+        self.stripes = stripes
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # Счётчики меняются только под замком своей полосы
+        self.acquisitions = [0] * stripes
+        self.contended = [0] * stripes
+        self.wait_time = [0.0] * stripes
+
+    @contextmanager
+    def hold(self, key):
+        index = hash(key) % self.stripes
+        lock = self._locks[index]
+        if not lock.acquire(blocking=False):
+            started = time.perf_counter()
+            lock.acquire()
+            self.contended[index] += 1
+            self.wait_time[index] += time.perf_counter() - started
+        self.acquisitions[index] += 1
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def stats(self):
+        """Contention counters, per_stripe lists only stripes that were used"""
+        acquisitions = sum(self.acquisitions)
+        contended = sum(self.contended)
+        return {
+            'stripes': self.stripes,
+            'acquisitions': acquisitions,
+            'contended': contended,
+            'contention_rate': contended / acquisitions if acquisitions else 0,
+            'wait_ms': sum(self.wait_time) * 1000,
+            'per_stripe': [
+                {'stripe': index, 'acquisitions': self.acquisitions[index],
+                 'contended': self.contended[index], 'wait_ms': self.wait_time[index] * 1000}
+                for index in range(self.stripes) if self.acquisitions[index]
+            ],
+        }
+
+
+class PeriodicWorker:
+    """Daemon thread calling func every interval seconds (or earlier on wake)"""
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            try:
+                self.func()
+            except Exception as e:
+                print(f"Error in {self.name}: {e}")
+
+    def wake(self):
+        """Run func now instead of waiting for interval"""
+        self._wakeup.set()
+
+    def stop(self):
+        """Stop thread and wait for current run"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+class LedgerWriter:
+    """Write-behind buffer for ledger rows
+    Rows are flushed with executemany in one commit every batch_size rows
+    or flush_interval seconds, so at most flush_interval of ledger may be lost.
+    When the background flush falls behind (max_pending rows buffered or the oldest row
+    waits longer than twice flush_interval) append() writes the buffer itself.
+    write_rows(rows, commit) must finish its transaction with commit(conn)"""
+
+    def __init__(self, write_rows, batch_size=200, flush_interval=0.2, max_pending=2000):
+        self.write_rows = write_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._rows = []
+        # Снятые на запись строки остаются видны читателям до коммита
+        self._inflight = []
+        # Коммит пачки и чтение "буфер + база" не пересекаются: читатель видит строку ровно один раз
+        self.visibility = threading.Lock()
+        # Когда в пустой буфер попала первая строка (time.monotonic)
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.batches = 0
+        self.rows_written = 0
+        self.max_batch = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.failed_flushes = 0
+        self.sync_flushes = 0
+        self.worker = PeriodicWorker('ledger-writer', flush_interval, self.flush)
+        self.worker.start()
+
+    def append(self, rows):
+        """Buffer ledger rows
+        Flushes in the calling thread if the buffer is over its limits"""
+        with self._lock:
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.extend(rows)
+            full = len(self._rows) >= self.batch_size
+            overdue = self._overdue()
+        if overdue:
+            # Фоновая запись не успевает или база не принимает строки - пишущий поток ждёт сам,
+            # а не копит журнал в памяти сверх лимита
+            self.sync_flushes += 1
+            self.flush()
+        elif full:
+            self.worker.wake()
+
+    def _commit(self, conn):
+        with self.visibility:
+            conn.commit()
+            with self._lock:
+                self._inflight = []
+
+    def pending(self, user_id=None):
+        """Rows not committed yet (all or of one user), oldest first
+        Hold visibility while reading them together with the database"""
+        with self._lock:
+            rows = self._inflight + self._rows
+        if user_id is None:
+            return rows
+        return [row for row in rows if row[0] == user_id]
+
+    def _overdue(self):
+        if len(self._rows) >= self.max_pending:
+            return True
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.flush_interval * 2
+
+    def flush(self):
+        """Write all buffered rows in one transaction"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                self._inflight = rows
+                oldest, self._oldest = self._oldest, None
+            if not rows:
+                return 0
+
+            started = time.perf_counter()
+            try:
+                self.write_rows(rows, self._commit)
+            except sqlite3.Error as e:
+                # Возвращаем строки в буфер, попробуем в следующий раз
+                print(f"Database error in ledger flush: {e}")
+                with self._lock:
+                    self._rows[:0] = rows
+                    self._inflight = []
+                    self._oldest = oldest
+                self.failed_flushes += 1
+                return 0
+            elapsed = time.perf_counter() - started
+
+            self.batches += 1
+            self.rows_written += len(rows)
+            self.max_batch = max(self.max_batch, len(rows))
+            self.flush_time += elapsed
+            self.max_flush_time = max(self.max_flush_time, elapsed)
+            return len(rows)
+
+    def stats(self):
+        """Batch size and flush latency counters"""
+        with self._lock:
+            pending = len(self._rows)
+            oldest = self._oldest
+        return {
+            'pending': pending,
+            'max_pending': self.max_pending,
+            'oldest_ms': (time.monotonic() - oldest) * 1000 if oldest is not None else 0,
+            'overdue': pending >= self.max_pending or (
+                oldest is not None and time.monotonic() - oldest >= self.flush_interval * 2),
+            'sync_flushes': self.sync_flushes,
+            'batches': self.batches,
+            'rows': self.rows_written,
+            'avg_batch': self.rows_written / self.batches if self.batches else 0,
+            'max_batch': self.max_batch,
+            'avg_flush_ms': self.flush_time * 1000 / self.batches if self.batches else 0,
+            'max_flush_ms': self.max_flush_time * 1000,
+            'failed_flushes': self.failed_flushes,
+        }
+
+    def close(self):
+        """Stop background flushing and write the rest"""
+        self.worker.stop()
+        self.flush()
+
+
+class StatsAggregator:
+    """Write-behind buffer for game_stats
+    Rounds are summed per (user_id, game_type) in memory and written with one batched upsert
+    every flush_interval seconds or when batch_size players/games are pending.
+    write_deltas(rows, commit) must finish its transaction with commit(conn)"""
+
+    def __init__(self, write_deltas, batch_size=500, flush_interval=1.0):
+        self.write_deltas = write_deltas
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # (user_id, game_type) -> [played, won, bet, won amount]
+        self._pending = {}
+        # Снятые на запись дельты остаются видны читателям до коммита
+        self._inflight = {}
+        # Коммит пачки и чтение "буфер + база" не пересекаются: читатель учитывает раунд ровно один раз
+        self.visibility = threading.Lock()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.rounds = 0
+        self.batches = 0
+        self.rows_written = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.failed_flushes = 0
+        self.worker = PeriodicWorker('stats-aggregator', flush_interval, self.flush)
+        self.worker.start()
+
+    def add(self, user_id, game_type, won, bet_amount, win_amount):
+        """Buffer one round"""
+        with self._lock:
+            delta = self._pending.setdefault((user_id, game_type), [0, 0, 0, 0])
+            delta[0] += 1
+            delta[1] += 1 if won else 0
+            delta[2] += bet_amount
+            delta[3] += win_amount
+            self.rounds += 1
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.worker.wake()
+
+    def _commit(self, conn):
+        with self.visibility:
+            conn.commit()
+            with self._lock:
+                self._inflight = {}
+
+    def pending_for(self, user_id):
+        """Uncommitted deltas of user {game_type: [played, won, bet, won amount]}
+        Hold visibility while reading them together with the database"""
+        with self._lock:
+            result = {}
+            for deltas in (self._inflight, self._pending):
+                for (delta_user, game_type), delta in deltas.items():
+                    if delta_user == user_id:
+                        total = result.setdefault(game_type, [0, 0, 0, 0])
+                        for index, value in enumerate(delta):
+                            total[index] += value
+            return result
+
+    def flush(self):
+        """Write all pending deltas in one transaction"""
+        with self._flush_lock:
+            with self._lock:
+                self._inflight, self._pending = self._pending, {}
+                rows = [(user_id, game_type, *delta) for (user_id, game_type), delta in self._inflight.items()]
+            if not rows:
+                return 0
+
+            started = time.perf_counter()
+            try:
+                self.write_deltas(rows, self._commit)
+            except sqlite3.Error as e:
+                # Возвращаем дельты в буфер, попробуем в следующий раз
+                print(f"Database error in stats flush: {e}")
+                with self._lock:
+                    for key, delta in self._inflight.items():
+                        total = self._pending.setdefault(key, [0, 0, 0, 0])
+                        for index, value in enumerate(delta):
+                            total[index] += value
+                    self._inflight = {}
+                self.failed_flushes += 1
+                return 0
+            elapsed = time.perf_counter() - started
+
+            self.batches += 1
+            self.rows_written += len(rows)
+            self.flush_time += elapsed
+            self.max_flush_time = max(self.max_flush_time, elapsed)
+            return len(rows)
+
+    def stats(self):
+        """Rounds vs upserted rows and flush latency"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'rounds': self.rounds,
+            'batches': self.batches,
+            'rows': self.rows_written,
+            'avg_batch': self.rows_written / self.batches if self.batches else 0,
+            'avg_flush_ms': self.flush_time * 1000 / self.batches if self.batches else 0,
+            'max_flush_ms': self.max_flush_time * 1000,
+            'failed_flushes': self.failed_flushes,
+        }
+
+    def close(self):
+        """Stop background flushing and write the rest"""
+        self.worker.stop()
+        self.flush()
+
+
+def read_only(method):
+    """Mark Database method as read-only: it uses reader connections and never takes write_lock"""
+    method.read_only = True
+    return method
+
+
+class AsyncDatabase:
+    """Awaitable facade over Database: every call runs in a worker thread"""
+
+    def __init__(self, database, workers=4, read_workers=4, max_pending=1000):
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+        # Чтения не стоят в очереди за записями, ждущими write_lock
+        self.read_executor = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-read')
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(max_pending)
+        self.pending = 0
+        self.running = 0
+        self.peak_pending = 0
+        self.completed = 0
+
+    async def run(self, func, *args, **kwargs):
+        """Run blocking function in executor with bounded number of in-flight calls"""
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        try:
+            async with self._slots:
+                self.running += 1
+                try:
+                    loop = asyncio.get_running_loop()
+                    executor = self.read_executor if getattr(func, 'read_only', False) else self.executor
+                    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+                finally:
+                    self.running -= 1
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        return call
+
+    def get_queue_stats(self):
+        """Queue depth counters"""
+        return {
+            'pending': self.pending,
+            'waiting': self.pending - self.running,
+            'running': self.running,
+            'peak_pending': self.peak_pending,
+            'max_pending': self.max_pending,
+            'completed': self.completed,
+        }
+
+    def close(self):
+        """Wait for running queries and close database"""
+        self.executor.shutdown(wait=True)
+        self.read_executor.shutdown(wait=True)
+        self.database.close()
+
+
 class Database:
-    def __init__(self, db_name):
+    def __init__(self, db_name, pool_size=5, pool_max_lifetime=3600, profile='balanced',
+                 ledger_batch_size=0, ledger_flush_interval=0.2, ledger_max_pending=2000,
+                 balance_cache_size=10000, balance_cache_enabled=True, balance_cache_ttl=2.0,
+                 ban_refresh_interval=60, leaderboard_size=10, partition_check_interval=3600,
+                 archive_dir='archive', archive_after_days=90, archive_interval=0, lock_stripes=64,
+                 write_retries=8, write_backoff=0.005, backup_dir='backups', backup_interval=0,
+                 backup_keep_last=8, backup_keep_days=7, backup_step_pages=256, backup_step_sleep=0.01,
+                 reconcile_interval=0, reconcile_chunk_size=5000, reconcile_duty_cycle=0.1,
+                 reconcile_settle=30, wallet=None, wallet_sync_interval=5, activity_flush_interval=5,
+                 stats_batch_size=0, stats_flush_interval=1.0, backfill_interval=60,
+                 backfill_chunk_size=2000, backfill_pause=0.02):
+        if profile not in PRAGMA_PROFILES:
+            raise ValueError(f"Unknown database profile: {profile}")
         self.db_name = db_name
-        self.lock = threading.Lock()
+        self.profile = profile
+        # Все записи идут через одно соединение писателя под write_lock,
+        # чтения - через пул соединений только для чтения и без блокировки (снимки WAL)
+        self.write_lock = threading.Lock()
+        # Операции с балансом одного игрока идут строго по очереди. Разные игроки не ждут друг друга
+        # на проверке баланса и кэше, но их транзакции SQLite по-прежнему идут по одной под write_lock
+        self.user_locks = StripedLock(lock_stripes)
+        self.write_retries = write_retries
+        self.write_backoff = write_backoff
+        self.write_stats = {'transactions': 0, 'conflicts': 0, 'busy': 0, 'retries': 0, 'failed': 0}
+        self.writer = ConnectionPool(self.get_connection, size=1, max_lifetime=pool_max_lifetime)
+        self.readers = ConnectionPool(self.get_read_connection, size=pool_size,
+                                      max_lifetime=pool_max_lifetime)
+        self.balances = BalanceCache(max_size=balance_cache_size, enabled=balance_cache_enabled,
+                                     ttl=balance_cache_ttl)
+        # last_active копится в памяти и пишется одним UPDATE раз в activity_flush_interval секунд
+        self.activity = ActivityTracker()
+        # Множество банов только подменяется целиком; ban_changes считает баны через бота
+        self.banned = set()
+        self.ban_lock = threading.Lock()
+        self.ban_changes = 0
+        self.leaderboard = Leaderboard(size=leaderboard_size)
+        self.partitions = {}
+        self.archived_months = []
+        # kind -> {name: code} и kind -> {code: name}
+        self.type_codes = {kind: {} for kind in TYPE_KINDS}
+        self.type_names = {kind: {} for kind in TYPE_KINDS}
+        self.archive = LedgerArchive(archive_dir)
+        self.archive_after_days = archive_after_days
+        self.backups = BackupManager(self.get_read_connection, directory=backup_dir,
+                                     prefix=os.path.splitext(os.path.basename(db_name))[0],
+                                     step_pages=backup_step_pages, step_sleep=backup_step_sleep,
+                                     keep_last=backup_keep_last, keep_days=backup_keep_days)
+        # Сверка балансов с журналом: сколько строк за шаг, доля времени работы и сколько секунд
+        # игрок должен не играть, чтобы его строки журнала точно вышли из буфера
+        self.reconcile_lock = threading.Lock()
+        self.reconcile_chunk_size = reconcile_chunk_size
+        self.reconcile_duty_cycle = reconcile_duty_cycle
+        self.reconcile_settle = reconcile_settle
+        self.reconcile_stats = {'passes': 0, 'rows': 0, 'checked': 0, 'baselined': 0, 'drifting': 0,
+                                'last_id': 0, 'last_seconds': 0.0}
+        # Балансы в памяти (WalletEngine) вместо users.balance; в users они переносятся пачками
+        self.wallet = wallet
+        self.wallet_released = False
+        # Фоновые переносы данных после миграций: строк журнала за транзакцию и пауза между ними
+        self.backfill_chunk_size = backfill_chunk_size
+        self.backfill_pause = backfill_pause
+        self.closed = False
         self.init_db()
-    
+        self.refresh_bans()
+        self.load_leaderboard()
+        if self.wallet:
+            self._attach_wallet()
+
+        # Заранее создаём партицию журнала на следующий месяц
+        self.partition_keeper = None
+        if partition_check_interval > 0:
+            self.partition_keeper = PeriodicWorker('ledger-partitions', partition_check_interval,
+                                                   self.ensure_partitions)
+            self.partition_keeper.start()
+
+        # Перенос старых месяцев журнала в сжатый архив
+        self.archiver = None
+        if archive_interval > 0:
+            self.archiver = PeriodicWorker('ledger-archive', archive_interval,
+                                           lambda: self.archive_ledger(self.archive_after_days))
+            self.archiver.start()
+
+        # Снимки базы на лету через backup API
+        self.backup_worker = None
+        if backup_interval > 0:
+            self.backup_worker = PeriodicWorker('db-backup', backup_interval, self.backup)
+            self.backup_worker.start()
+
+        # Инкрементальная сверка балансов с журналом в фоне
+        self.reconciler = None
+        if reconcile_interval > 0:
+            self.reconciler = PeriodicWorker('ledger-reconcile', reconcile_interval, self.reconcile)
+            self.reconciler.start()
+
+        self.activity_flusher = None
+        if activity_flush_interval > 0:
+            self.activity_flusher = PeriodicWorker('activity-flush', activity_flush_interval,
+                                                   self.flush_activity)
+            self.activity_flusher.start()
+
+        # Перенос балансов из кошелька в users
+        self.wallet_syncer = None
+        if self.wallet and wallet_sync_interval > 0:
+            self.wallet_syncer = PeriodicWorker('wallet-sync', wallet_sync_interval, self.sync_wallet)
+            self.wallet_syncer.start()
+
+        # Переносы данных, назначенные миграциями схемы; когда их нет, поток ничего не делает
+        self.backfiller = None
+        if self.backfills and backfill_interval > 0:
+            self.backfiller = PeriodicWorker('schema-backfill', backfill_interval, self.run_backfills)
+            self.backfiller.start()
+            self.backfiller.wake()
+
+        # Периодически перечитываем баны, выданные мимо бота (например, вручную в БД)
+        self.ban_refresher = None
+        if ban_refresh_interval > 0:
+            self.ban_refresher = PeriodicWorker('ban-refresh', ban_refresh_interval, self.refresh_bans)
+            self.ban_refresher.start()
+
+        # Отложенная запись журнала транзакций (0 - писать сразу)
+        self.ledger = None
+        if ledger_batch_size > 0:
+            self.ledger = LedgerWriter(self._write_ledger_rows, batch_size=ledger_batch_size,
+                                       flush_interval=ledger_flush_interval, max_pending=ledger_max_pending)
+
+        # Отложенная запись game_stats суммами по игроку и игре (0 - писать в транзакции раунда)
+        self.stats_buffer = None
+        if stats_batch_size > 0:
+            self.stats_buffer = StatsAggregator(self._write_game_stats, batch_size=stats_batch_size,
+                                                flush_interval=stats_flush_interval)
+
+        if self.ledger or self.stats_buffer:
+            atexit.register(self.close)
+
     def get_connection(self):
         """Creating Connection"""
         conn = sqlite3.connect(self.db_name, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        for pragma, value in PRAGMA_PROFILES[self.profile].items():
+            conn.execute(f'PRAGMA {pragma} = {value}').fetchall()
+        return conn
+
+    def get_read_connection(self):
+        """Creating read-only connection"""
+        conn = self.get_connection()
+        conn.execute('PRAGMA query_only = ON')
         return conn
-    
+
+    @read_only
+    def get_pragma_report(self):
+        """Effective pragmas of pooled connection"""
+        report = {'profile': self.profile}
+        with self.readers.connection() as conn:
+            for pragma in REPORTED_PRAGMAS:
+                report[pragma] = conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+        report['synchronous'] = SYNCHRONOUS_NAMES.get(report['synchronous'], report['synchronous'])
+        report['temp_store'] = TEMP_STORE_NAMES.get(report['temp_store'], report['temp_store'])
+        return report
+
+    @read_only
+    def get_pool_stats(self):
+        """Writer and reader pools hit/miss counters"""
+        return {'writer': self.writer.stats(), 'readers': self.readers.stats()}
+
+    @read_only
+    def get_cache_stats(self):
+        """Balance cache counters"""
+        return self.balances.stats()
+
+    @read_only
+    def get_lock_stats(self):
+        """Per-user lock stripes contention counters"""
+        return self.user_locks.stats()
+
+    @read_only
+    def get_write_stats(self):
+        """Write transactions, version conflicts and busy retries"""
+        return dict(self.write_stats)
+
+    @read_only
+    def get_backup_stats(self):
+        """Backup counters and metrics of the last snapshot"""
+        return self.backups.stats()
+
+    @read_only
+    def get_reconcile_stats(self):
+        """Reconciliation passes, verified rows and drifting accounts"""
+        return dict(self.reconcile_stats)
+
+    @read_only
+    def get_schema_stats(self):
+        """Schema version, migrations applied on start and pending backfills"""
+        stats = dict(self.schema_stats)
+        stats['backfills'] = dict(self.backfills)
+        return stats
+
+    @read_only
+    def get_stats_buffer_stats(self):
+        """Write-behind game_stats counters"""
+        return self.stats_buffer.stats() if self.stats_buffer else None
+
+    @read_only
+    def get_activity_stats(self):
+        """last_active touches and batched writes"""
+        return self.activity.stats()
+
+    @read_only
+    def get_wallet_stats(self):
+        """Wallet journal and snapshot counters"""
+        return self.wallet.stats() if self.wallet else None
+
+    @read_only
+    def get_ledger_stats(self):
+        """Write-behind ledger counters"""
+        return self.ledger.stats() if self.ledger else None
+
+    def close(self):
+        """Flush buffered ledger rows and close pooled connections"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.ban_refresher:
+            self.ban_refresher.stop()
+        if self.partition_keeper:
+            self.partition_keeper.stop()
+        if self.archiver:
+            self.archiver.stop()
+        if self.backup_worker:
+            self.backup_worker.stop()
+        if self.reconciler:
+            self.reconciler.stop()
+        if self.backfiller:
+            self.backfiller.stop()
+        if self.ledger:
+            self.ledger.close()
+        if self.stats_buffer:
+            self.stats_buffer.close()
+        if self.wallet:
+            if self.wallet_syncer:
+                self.wallet_syncer.stop()
+            self.sync_wallet()
+            self.wallet.close()
+        if self.activity_flusher:
+            self.activity_flusher.stop()
+        self.flush_activity()
+        self.writer.close()
+        self.readers.close()
+
     def init_db(self):
-        """Creating a tables for first opened"""
-        with self.lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Таблица пользователей - ИСПРАВЛЕНО: добавлена запятая после CHECK
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    balance INTEGER DEFAULT 0 CHECK(balance >= 0),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_banned INTEGER DEFAULT 0
-                )
-            ''')
-            
-            # Таблица транзакций
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
+        """Bring schema up to date, then load type codes and ledger partitions
+
+        PRAGMA user_version holds the number of applied SCHEMA_MIGRATIONS: a current database
+        runs no DDL at all, an older one gets the missing migrations in order, each in its own
+        transaction. Data backfills scheduled by migrations run later in small chunks.
+
+        Exception to the "never block more than a few ms" rule: a pre-compact database
+        (_migrate_compact_layout, _migrate_legacy_ledger in _schema_base) is rewritten in one
+        long transaction, because the text and integer layouts cannot be read side by side.
+        It happens once, at startup, before the bot serves updates; other bot processes
+        writing meanwhile fail once busy_timeout runs out, so stop them before upgrading"""
+        started = time.perf_counter()
+        applied = []
+        with self.write_lock, self.writer.connection() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            while version < len(SCHEMA_MIGRATIONS):
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    # Другой процесс бота мог обновить схему, пока мы ждали блокировку
+                    version = conn.execute('PRAGMA user_version').fetchone()[0]
+                    if version < len(SCHEMA_MIGRATIONS):
+                        getattr(self, SCHEMA_MIGRATIONS[version])(conn)
+                        version += 1
+                        conn.execute(f'PRAGMA user_version = {version}')
+                        applied.append(SCHEMA_MIGRATIONS[version - 1])
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+            if version > len(SCHEMA_MIGRATIONS):
+                print(f"Database schema version {version} is newer than this bot ({len(SCHEMA_MIGRATIONS)})")
+
+            self._load_partitions(conn)
+            self._load_type_codes(conn)
+            self.backfills = {name: (done_id, target_id) for name, done_id, target_id in conn.execute(
+                'SELECT name, done_id, target_id FROM schema_backfills')}
+        self.schema_stats = {'version': version, 'latest': len(SCHEMA_MIGRATIONS), 'applied': applied,
+                             'seconds': time.perf_counter() - started, 'backfill_chunks': 0,
+                             'backfill_rows': 0, 'backfill_max_ms': 0.0}
+        # Партиция нового месяца создаётся только если её ещё нет
+        self.ensure_partitions()
+
+    def _schema_base(self, conn):
+        """Migration 1: tables of the compact layout, old layouts are rebuilt into it"""
+        # Незаконченные переносы данных: строки журнала (done_id, target_id] ещё не учтены
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_backfills (
+                name TEXT PRIMARY KEY,
+                done_id INTEGER NOT NULL,
+                target_id INTEGER NOT NULL
+            )
+        ''')
+
+        # Справочник кодов игр и типов транзакций
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS type_codes (
+                kind TEXT NOT NULL,
+                code INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                PRIMARY KEY (kind, code),
+                UNIQUE (kind, name)
+            ) WITHOUT ROWID
+        ''')
+        for kind, names in DEFAULT_TYPE_CODES.items():
+            for name in names:
+                self._create_type_code(conn, kind, name)
+
+        # База со старой текстовой схемой перестраивается в компактную.
+        # Это делается сразу: старые таблицы не годятся для чтения ботом
+        if _column_type(conn, 'users', 'created_at') not in (None, 'INTEGER'):
+            self._migrate_compact_layout(conn)
+
+        conn.execute(USERS_SCHEMA.format(name='users'))
+
+        # Журнал транзакций хранится помесячно: transactions_YYYYMM + каталог партиций.
+        # transactions - представление (UNION ALL) поверх активных партиций
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ledger_partitions (
+                month TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                period_start TEXT NOT NULL,
+                period_end TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'active',
+                location TEXT
+            )
+        ''')
+
+        # Сквозная нумерация id транзакций для всех партиций
+        conn.execute('CREATE TABLE IF NOT EXISTS ledger_sequence (last_id INTEGER NOT NULL)')
+        conn.execute('''
+            INSERT INTO ledger_sequence (last_id)
+            SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM ledger_sequence)
+        ''')
+
+        # Таблица игровой статистики
+        conn.execute(GAME_STATS_SCHEMA.format(name='game_stats'))
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_users_banned ON users(user_id) WHERE is_banned = 1')
+
+        # Сводные таблицы по часам и дням для отчётов
+        rollups_missing = _column_type(conn, ROLLUP_PERIODS['hour'][0], 'period') is None
+        for table, _ in ROLLUP_PERIODS.values():
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    period TEXT NOT NULL,
                     game_type TEXT NOT NULL,
-                    amount INTEGER NOT NULL,
                     transaction_type TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
+                    tx_count INTEGER NOT NULL DEFAULT 0,
+                    total_amount INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (period, game_type, transaction_type)
                 )
             ''')
-            
-            # Таблица игровой статистики
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS game_stats (
-                    user_id INTEGER NOT NULL,
-                    game_type TEXT NOT NULL,
-                    games_played INTEGER DEFAULT 0 CHECK(games_played >= 0),
-                    games_won INTEGER DEFAULT 0 CHECK(games_won >= 0),
-                    total_bet INTEGER DEFAULT 0 CHECK(total_bet >= 0),
-                    total_won INTEGER DEFAULT 0 CHECK(total_won >= 0),
-                    PRIMARY KEY (user_id, game_type),
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
+
+        # Старая единая таблица transactions переезжает в партиции
+        legacy = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions'").fetchone()
+        if legacy:
+            self._migrate_legacy_ledger(conn)
+
+        for month in (_month_key(datetime.now()), _month_key(_next_month(datetime.now()))):
+            self._create_partition(conn, month)
+        self._rebuild_ledger_view(conn)
+
+        # Сводок не было - существующий журнал досчитывается в фоне, новые строки учитывают вставки
+        if rollups_missing:
+            self._schedule_backfill(conn, 'rollups')
+
+    def _schema_row_versions(self, conn):
+        """Migration 2: row version of users for compare-and-swap between bot processes"""
+        if _column_type(conn, 'users', 'version') is None:
+            conn.execute('ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+    def _schema_payments(self, conn):
+        """Migration 3: applied Telegram payments"""
+        # Платежи Telegram: повторно доставленный апдейт не должен начислить звёзды дважды
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS payments (
+                id INTEGER PRIMARY KEY,
+                charge_id TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                payload TEXT,
+                created_at INTEGER NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_charge_id ON payments(charge_id)')
+
+    def _schema_reconcile(self, conn):
+        """Migration 4: checkpoints of balance reconciliation"""
+        # Контрольные точки сверки баланса с журналом: баланс до первой учтённой строки,
+        # последняя учтённая строка игрока и сумма его строк журнала после неё
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS reconcile_checkpoints (
+                user_id INTEGER PRIMARY KEY,
+                opening_balance INTEGER,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                ledger_sum INTEGER NOT NULL DEFAULT 0,
+                checked_version INTEGER NOT NULL DEFAULT -1,
+                checked_at INTEGER NOT NULL DEFAULT 0,
+                drift INTEGER NOT NULL DEFAULT 0,
+                seen_version INTEGER NOT NULL DEFAULT -1,
+                seen_at INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # Версия строки, увиденная сверкой: счёт сверяется, когда она не меняется reconcile_settle секунд
+        if _column_type(conn, 'reconcile_checkpoints', 'seen_version') is None:
+            conn.execute('ALTER TABLE reconcile_checkpoints ADD COLUMN seen_version INTEGER NOT NULL DEFAULT -1')
+            conn.execute('ALTER TABLE reconcile_checkpoints ADD COLUMN seen_at INTEGER NOT NULL DEFAULT 0')
+        # Общая позиция сверки в журнале
+        conn.execute('CREATE TABLE IF NOT EXISTS reconcile_state (last_id INTEGER NOT NULL)')
+        conn.execute('''
+            INSERT INTO reconcile_state (last_id)
+            SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM reconcile_state)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_reconcile_drift ON reconcile_checkpoints(user_id) WHERE drift != 0
+        ''')
+
+    def _schema_wallet(self, conn):
+        """Migration 5: marker of balances kept by in-memory wallet"""
+        # Есть строка - балансы ведёт кошелёк в памяти, users.balance лишь его копия
+        conn.execute('CREATE TABLE IF NOT EXISTS wallet_state (attached_at INTEGER NOT NULL)')
+
+    def _schedule_backfill(self, conn, name):
+        """Schedule backfill of ledger rows written so far, newer rows are handled by regular writes"""
+        target_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+        if target_id:
+            conn.execute('INSERT OR REPLACE INTO schema_backfills (name, done_id, target_id) VALUES (?, 0, ?)',
+                         (name, target_id))
+
+    def run_backfills(self, chunk_size=None, pause=None, progress=None):
+        """Run scheduled backfills in id chunks of chunk_size, each in its own short transaction,
+        sleeping pause seconds between chunks so the bot keeps writing
+        Returns True when nothing is left"""
+        chunk_size = chunk_size or self.backfill_chunk_size
+        pause = self.backfill_pause if pause is None else pause
+        stats = self.schema_stats
+        for name in list(self.backfills):
+            while not self.closed:
+                step_started = time.perf_counter()
+                try:
+                    step = self._write(lambda conn: self._backfill_step(conn, name, chunk_size))
+                except sqlite3.Error as e:
+                    print(f"Database error in run_backfills: {e}")
+                    return False
+                if step is None:
+                    self.backfills.pop(name, None)
+                    break
+                done_id, target_id, rows = step
+                stats['backfill_chunks'] += 1
+                stats['backfill_rows'] += rows
+                stats['backfill_max_ms'] = max(stats['backfill_max_ms'],
+                                               (time.perf_counter() - step_started) * 1000)
+                if progress:
+                    progress(name, done_id, target_id)
+                if done_id >= target_id:
+                    self.backfills.pop(name, None)
+                    break
+                self.backfills[name] = (done_id, target_id)
+                time.sleep(pause)
+        return not self.backfills
+
+    def _backfill_step(self, conn, name, chunk_size):
+        """Process next chunk of backfill inside current transaction
+        Returns (done_id, target_id, ledger ids covered) or None if backfill is already finished"""
+        # Позицию читаем под блокировкой записи: другой процесс мог продвинуть её сам
+        row = conn.execute('SELECT done_id, target_id FROM schema_backfills WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        done_id, target_id = row
+        upper_id = min(done_id + chunk_size, target_id)
+        getattr(self, SCHEMA_BACKFILLS[name])(conn, done_id, upper_id)
+        if upper_id >= target_id:
+            conn.execute('DELETE FROM schema_backfills WHERE name = ?', (name,))
+        else:
+            conn.execute('UPDATE schema_backfills SET done_id = ? WHERE name = ?', (upper_id, name))
+        return upper_id, target_id, upper_id - done_id
+
+    def _migrate_compact_layout(self, conn):
+        """Rebuild users, game_stats and ledger partitions of the old text layout
+        (text timestamps, type names in every row) into compact tables"""
+        view = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'transactions'").fetchone()
+        if view:
+            conn.execute('DROP VIEW transactions')
+
+        # Новую таблицу заполняем рядом и подменяем ею старую:
+        # RENAME самой старой таблицы переписал бы внешние ключи партиций на неё
+        conn.execute(USERS_SCHEMA.format(name='users_compact'))
+        conn.execute(f'''
+            INSERT INTO users_compact (user_id, username, balance, created_at, last_active, is_banned)
+            SELECT user_id, username, balance, {TEXT_TO_EPOCH.format(column='created_at')},
+                   {TEXT_TO_EPOCH.format(column='last_active')}, is_banned
+            FROM users
+        ''')
+        conn.execute('DROP TABLE users')
+        conn.execute('ALTER TABLE users_compact RENAME TO users')
+
+        if _column_type(conn, 'game_stats', 'game_type') is not None:
+            for (name,) in conn.execute('SELECT DISTINCT game_type FROM game_stats').fetchall():
+                self._create_type_code(conn, 'game', name)
+            conn.execute(GAME_STATS_SCHEMA.format(name='game_stats_compact'))
+            conn.execute('''
+                INSERT INTO game_stats_compact
+                    (user_id, game_type, games_played, games_won, total_bet, total_won)
+                SELECT s.user_id, c.code, s.games_played, s.games_won, s.total_bet, s.total_won
+                FROM game_stats s
+                JOIN type_codes c ON c.kind = 'game' AND c.name = s.game_type
             ''')
-            
-            # Индексы для оптимизации
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(user_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_time ON transactions(timestamp)')
-            
-            conn.commit()
-            conn.close()
-    
+            conn.execute('DROP TABLE game_stats')
+            conn.execute('ALTER TABLE game_stats_compact RENAME TO game_stats')
+
+        if _column_type(conn, 'ledger_partitions', 'month') is not None:
+            rows = conn.execute(
+                "SELECT month, name FROM ledger_partitions WHERE state = 'active'").fetchall()
+            for month, name in rows:
+                if _column_type(conn, name, 'timestamp') in (None, 'INTEGER'):
+                    continue
+                conn.execute(f'ALTER TABLE {name} RENAME TO {name}_text')
+                conn.execute(f'DROP INDEX IF EXISTS idx_{name}_user_id')
+                conn.execute(f'DROP INDEX IF EXISTS idx_{name}_time')
+                self._create_partition(conn, month)
+                self._copy_text_ledger(conn, f'{name}_text', name)
+                conn.execute(f'DROP TABLE {name}_text')
+
+    def _copy_text_ledger(self, conn, source, target, where='', params=()):
+        """Copy rows of old text layout ledger table into compact partition"""
+        for kind, column in TYPE_KINDS.items():
+            for (name,) in conn.execute(f'SELECT DISTINCT {column} FROM {source} {where}', params).fetchall():
+                self._create_type_code(conn, kind, name)
+        conn.execute(f'''
+            INSERT INTO {target} ({LEDGER_COLUMNS})
+            SELECT t.id, t.user_id, g.code, t.amount, k.code,
+                   COALESCE({TEXT_TO_EPOCH.format(column='t.timestamp')}, CAST(strftime('%s', 'now') AS INTEGER))
+            FROM {source} t
+            JOIN type_codes g ON g.kind = 'game' AND g.name = t.game_type
+            JOIN type_codes k ON k.kind = 'transaction' AND k.name = t.transaction_type
+            {where}
+        ''', params)
+
+    def _create_type_code(self, conn, kind, name):
+        """Code of game/transaction type name, unknown names get next free code"""
+        conn.execute('''
+            INSERT OR IGNORE INTO type_codes (kind, code, name)
+            SELECT ?, COALESCE(MAX(code), 0) + 1, ? FROM type_codes WHERE kind = ?
+        ''', (kind, name, kind))
+        return conn.execute('SELECT code FROM type_codes WHERE kind = ? AND name = ?',
+                            (kind, name)).fetchone()[0]
+
+    def _load_type_codes(self, conn):
+        codes = {kind: {} for kind in TYPE_KINDS}
+        for kind, code, name in conn.execute('SELECT kind, code, name FROM type_codes'):
+            codes.setdefault(kind, {})[name] = code
+        self.type_codes = codes
+        self.type_names = {kind: {code: name for name, code in names.items()}
+                           for kind, names in codes.items()}
+
+    def _type_code(self, conn, kind, name):
+        """Code for type name inside current transaction"""
+        code = self.type_codes[kind].get(name)
+        if code is None:
+            # Имя не подготовлено через _prepare_ledger - заводим код в этой же транзакции
+            code = self._create_type_code(conn, kind, name)
+        return code
+
+    def _type_name(self, kind, code):
+        """Type name for code (codes added by another process are reloaded)"""
+        name = self.type_names[kind].get(code)
+        if name is None:
+            with self.readers.connection() as conn:
+                self._load_type_codes(conn)
+            name = self.type_names[kind].get(code)
+        return name
+
+    def _decode_ledger_row(self, row):
+        """Stored ledger row -> (id, user_id, game_type, amount, transaction_type, timestamp)
+        with type names and text timestamp"""
+        row_id, user_id, game_code, amount, transaction_code, timestamp = row
+        return (row_id, user_id, self._type_name('game', game_code), amount,
+                self._type_name('transaction', transaction_code), _from_epoch(timestamp))
+
+    def _migrate_legacy_ledger(self, conn):
+        """Move rows of single transactions table into monthly partitions"""
+        current_month = _month_key(datetime.now())
+        months = [row[0] for row in conn.execute('''
+            SELECT DISTINCT COALESCE(strftime('%Y%m', timestamp), ?) FROM transactions
+        ''', (current_month,))]
+
+        for month in months:
+            name = self._create_partition(conn, month)
+            self._copy_text_ledger(conn, 'transactions', name,
+                                   "WHERE COALESCE(strftime('%Y%m', timestamp), ?) = ?",
+                                   (current_month, month))
+
+        conn.execute('''
+            UPDATE ledger_sequence
+            SET last_id = MAX(last_id, (SELECT COALESCE(MAX(id), 0) FROM transactions))
+        ''')
+        conn.execute('DROP TABLE transactions')
+
+    def _create_partition(self, conn, month):
+        """Create monthly ledger partition if needed, returns table name"""
+        name = f'transactions_{month}'
+        conn.execute(LEDGER_SCHEMA.format(name=name))
+        # Покрывающий индекс для постраничной истории: (user_id, id) + все выводимые поля
+        conn.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_{name}_user_id
+            ON {name}(user_id, id, game_type, amount, transaction_type, timestamp)
+        ''')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{name}_time ON {name}(timestamp)')
+
+        start = datetime.strptime(month, '%Y%m')
+        conn.execute('''
+            INSERT OR IGNORE INTO ledger_partitions (month, name, period_start, period_end)
+            VALUES (?, ?, ?, ?)
+        ''', (month, name, start.strftime('%Y-%m-%d'), _next_month(start).strftime('%Y-%m-%d')))
+        return name
+
+    def _rebuild_ledger_view(self, conn):
+        """Recreate transactions view over active partitions"""
+        names = [row[0] for row in conn.execute(
+            "SELECT name FROM ledger_partitions WHERE state = 'active' ORDER BY month")]
+        conn.execute('DROP VIEW IF EXISTS transactions')
+        if names:
+            conn.execute('CREATE VIEW transactions AS ' + ' UNION ALL '.join(
+                f'SELECT {LEDGER_COLUMNS} FROM {name}' for name in names))
+
+    def _load_partitions(self, conn):
+        rows = conn.execute(
+            "SELECT month, name FROM ledger_partitions WHERE state = 'active' ORDER BY month").fetchall()
+        self.partitions = {row['month']: row['name'] for row in rows}
+        self.archived_months = [row[0] for row in conn.execute(
+            "SELECT month FROM ledger_partitions WHERE state = 'archived' ORDER BY month")]
+
+    def ensure_partitions(self):
+        """Create partitions for current and next month (rollover)"""
+        with self.write_lock:
+            try:
+                with self.writer.connection() as conn:
+                    now = datetime.now()
+                    for month in (_month_key(now), _month_key(_next_month(now))):
+                        if month not in self.partitions:
+                            self._create_partition(conn, month)
+                            self._rebuild_ledger_view(conn)
+                    conn.commit()
+                    self._load_partitions(conn)
+                return True
+            except sqlite3.Error as e:
+                print(f"Database error in ensure_partitions: {e}")
+                return False
+
+    def _prepare_ledger(self, conn, rows, game_types=()):
+        """Create missing partitions and type codes for ledger rows before write transaction starts"""
+        missing_months = {_month_key(row[4]) for row in rows} - set(self.partitions)
+        names = {('game', game_type) for game_type in game_types}
+        names.update(('game', row[1]) for row in rows)
+        names.update(('transaction', row[3]) for row in rows)
+        missing_names = sorted((kind, name) for kind, name in names if name not in self.type_codes[kind])
+        if not missing_months and not missing_names:
+            return
+        for kind, name in missing_names:
+            self._create_type_code(conn, kind, name)
+        for month in missing_months:
+            self._create_partition(conn, month)
+        if missing_months:
+            self._rebuild_ledger_view(conn)
+        conn.commit()
+        self._load_partitions(conn)
+        self._load_type_codes(conn)
+
+    def _partition_for(self, conn, timestamp):
+        """Partition table for ledger row timestamp"""
+        month = _month_key(timestamp)
+        name = self.partitions.get(month)
+        if name is None:
+            # Партиции ещё нет (например, сразу после смены месяца) - создаём в этой же транзакции
+            name = self._create_partition(conn, month)
+            self._rebuild_ledger_view(conn)
+        return name
+
+    @read_only
+    def list_partitions(self):
+        """Ledger partitions [(month, name, state, location), ...]"""
+        with self.readers.connection() as conn:
+            rows = conn.execute(
+                'SELECT month, name, state, location FROM ledger_partitions ORDER BY month').fetchall()
+        return [tuple(row) for row in rows]
+
+    def _partitions_in_range(self, since=None, until=None):
+        """Active partition names overlapping [since, until), oldest first"""
+        months = _months_in_range(self.partitions, since, until)
+        return [self.partitions[month] for month in months]
+
+    def _reload_partitions(self, conn, error):
+        """Reload partition catalog if error says a partition is gone
+        (archived or detached by another bot process). Returns True if the read may be retried"""
+        if 'no such table' not in str(error):
+            return False
+        self._load_partitions(conn)
+        return True
+
+    def archive_ledger(self, older_than_days=90, chunk_size=5000, progress=None):
+        """Move partitions older than older_than_days into compressed archive files
+        Returns number of archived rows"""
+        cutoff = (datetime.now() - timedelta(days=older_than_days)).strftime('%Y-%m-%d')
+        self.flush_ledger()
+        with self.readers.connection() as conn:
+            candidates = conn.execute('''
+                SELECT month, name FROM ledger_partitions
+                WHERE state = 'active' AND period_end <= ?
+                ORDER BY month
+            ''', (cutoff,)).fetchall()
+
+        total = 0
+        for month, name in candidates:
+            try:
+                while True:
+                    # Месяц давно закрыт, поэтому читать и сжимать можно без блокировки
+                    with self.readers.connection() as conn:
+                        rows = [self._decode_ledger_row(row) for row in conn.execute(
+                            f'SELECT {LEDGER_COLUMNS} FROM {name} ORDER BY id LIMIT ?', (chunk_size,))]
+                    if not rows:
+                        break
+                    self.archive.append(month, rows)
+
+                    with self.write_lock, self.writer.connection() as conn:
+                        conn.execute(f'DELETE FROM {name} WHERE id <= ?', (rows[-1][0],))
+                        conn.commit()
+                    total += len(rows)
+                    if progress:
+                        progress(month, total)
+
+                with self.write_lock, self.writer.connection() as conn:
+                    conn.execute('''
+                        UPDATE ledger_partitions SET state = 'archived', location = ? WHERE month = ?
+                    ''', (self.archive.data_path(month), month))
+                    conn.execute(f'DROP TABLE {name}')
+                    self._rebuild_ledger_view(conn)
+                    conn.commit()
+                    self._load_partitions(conn)
+            except (sqlite3.Error, OSError) as e:
+                print(f"Error in archive_ledger for {month}: {e}")
+                break
+        return total
+
+    def backup(self):
+        """Take verified online snapshot and prune old ones by retention policy
+        Returns snapshot metrics or None"""
+        # Буфер журнала пишем в базу, чтобы он попал в снимок
+        self.flush_ledger()
+        try:
+            report = self.backups.create()
+        except Exception as e:
+            print(f"Error in backup: {e}")
+            return None
+        try:
+            report['pruned'] = self.backups.prune()
+        except OSError as e:
+            print(f"Error in backup prune: {e}")
+            report['pruned'] = []
+        return report
+
+    def detach_partition(self, month, directory='.'):
+        """Move old partition out of casino.db into ledger_YYYYMM.db
+        Return path of the file or None"""
+        if month >= _month_key(datetime.now()):
+            print(f"Partition {month} is current or future and can not be detached")
+            return None
+        name = self.partitions.get(month)
+        if name is None:
+            return None
+
+        path = os.path.join(directory, f'ledger_{month}.db')
+        self.flush_ledger()
+        with self.write_lock:
+            try:
+                with self.writer.connection() as conn:
+                    conn.commit()
+                    conn.execute('ATTACH DATABASE ? AS cold', (path,))
+                    try:
+                        # Сначала надёжно копируем в отдельный файл, потом удаляем из основной базы
+                        conn.execute(f'''
+                            CREATE TABLE IF NOT EXISTS cold.{name} (
+                                id INTEGER PRIMARY KEY,
+                                user_id INTEGER NOT NULL,
+                                game_type TEXT NOT NULL,
+                                amount INTEGER NOT NULL,
+                                transaction_type TEXT NOT NULL,
+                                timestamp TIMESTAMP
+                            )
+                        ''')
+                        # Файл партиции самодостаточен: имена типов и текстовое время вместо кодов
+                        conn.execute(f'''
+                            INSERT OR IGNORE INTO cold.{name} ({LEDGER_COLUMNS})
+                            SELECT t.id, t.user_id, g.name, t.amount, k.name,
+                                   datetime(t.timestamp, 'unixepoch', 'localtime')
+                            FROM main.{name} t
+                            JOIN type_codes g ON g.kind = 'game' AND g.code = t.game_type
+                            JOIN type_codes k ON k.kind = 'transaction' AND k.code = t.transaction_type
+                        ''')
+                        conn.commit()
+                    finally:
+                        if conn.in_transaction:
+                            conn.rollback()
+                        conn.execute('DETACH DATABASE cold')
+
+                    conn.execute('''
+                        UPDATE ledger_partitions SET state = 'detached', location = ? WHERE month = ?
+                    ''', (path, month))
+                    conn.execute(f'DROP TABLE {name}')
+                    self._rebuild_ledger_view(conn)
+                    conn.commit()
+                    self._load_partitions(conn)
+                return path
+            except sqlite3.Error as e:
+                print(f"Database error in detach_partition: {e}")
+                return None
+
+    def _write(self, func, rows=(), game_types=(), commit=None):
+        """Run func(conn) in one BEGIN IMMEDIATE transaction on the writer connection and commit it
+        (with commit(conn) if given). Version conflicts and busy database (other bot processes)
+        are retried with bounded backoff"""
+        for attempt in range(self.write_retries + 1):
+            try:
+                with self.write_lock, self.writer.connection() as conn:
+                    self._prepare_ledger(conn, rows, game_types)
+                    # Блокировку записи берём сразу: отложенная транзакция может упасть с busy
+                    # при повышении блокировки, когда другой процесс уже пишет
+                    conn.execute('BEGIN IMMEDIATE')
+                    result = func(conn)
+                    if commit:
+                        commit(conn)
+                    else:
+                        conn.commit()
+                self.write_stats['transactions'] += 1
+                return result
+            except sqlite3.OperationalError as e:
+                if isinstance(e, VersionConflict):
+                    self.write_stats['conflicts'] += 1
+                elif 'locked' in str(e) or 'busy' in str(e):
+                    self.write_stats['busy'] += 1
+                else:
+                    raise
+                if attempt == self.write_retries:
+                    self.write_stats['failed'] += 1
+                    raise
+            self.write_stats['retries'] += 1
+            time.sleep(random.uniform(0, min(self.write_backoff * 2 ** attempt, WRITE_BACKOFF_CAP)))
+
+    def _attach_wallet(self):
+        """Make wallet the owner of balances
+        Seeds it from users when balances were last changed through SQLite
+        and opens wallets for users rows it does not know yet"""
+        with self.readers.connection() as conn:
+            attached = conn.execute('SELECT 1 FROM wallet_state').fetchone() is not None
+            balances = dict(conn.execute('SELECT user_id, balance FROM users').fetchall())
+        if not attached:
+            self.wallet.reset(balances)
+            with self.write_lock, self.writer.connection() as conn:
+                conn.execute('INSERT INTO wallet_state (attached_at) VALUES (?)', (int(time.time()),))
+                conn.commit()
+            return
+        # Игрок добавлен в users, а кошелёк не успел записать его создание (сбой между ними)
+        # или строку вставил процесс без кошелька - открываем кошелёк с балансом из users
+        for user_id, balance in balances.items():
+            if self.wallet.get(user_id) is None:
+                self.wallet.create(user_id, balance)
+        # После сбоя users может отставать от кошелька на интервал переноса
+        self.wallet.mark_dirty([user_id for user_id, balance in balances.items()
+                                if self.wallet.get(user_id) != balance])
+
+    def sync_wallet(self):
+        """Write balances changed in wallet to users in one transaction
+        Returns number of updated users"""
+        dirty = self.wallet.drain_dirty()
+        if not dirty:
+            return 0
+        try:
+            self._write(lambda conn: conn.executemany(
+                'UPDATE users SET balance = ?, version = version + 1 WHERE user_id = ?',
+                [(balance, user_id) for user_id, balance in dirty]))
+            return len(dirty)
+        except sqlite3.Error as e:
+            print(f"Database error in sync_wallet: {e}")
+            self.wallet.mark_dirty([user_id for user_id, _ in dirty])
+            return 0
+
+    def touch(self, user_id):
+        """Remember user activity, written to users.last_active by flush_activity"""
+        self.activity.touch(user_id)
+
+    def flush_activity(self):
+        """Write pending last_active values in one transaction, returns number of users"""
+        rows = self.activity.drain()
+        if not rows:
+            return 0
+        try:
+            self._write(lambda conn: conn.executemany(
+                'UPDATE users SET last_active = MAX(last_active, ?) WHERE user_id = ?', rows))
+            self.activity.flushed(len(rows))
+            return len(rows)
+        except sqlite3.Error as e:
+            print(f"Database error in flush_activity: {e}")
+            self.activity.restore(rows)
+            return 0
+
+    def _commit_balance(self, user_id, amount, result):
+        """Publish committed balance change to wallet or balance cache, returns new balance"""
+        new_balance, version = result
+        if self.wallet:
+            return self.wallet.apply(user_id, amount)
+        self.balances.set(user_id, new_balance, version)
+        self.wallet_released = True
+        return new_balance
+
     def add_user(self, user_id, username, start_balance):
         """Add new member"""
-        with self.lock:
+        def insert(conn):
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO users (user_id, username, balance, created_at, last_active)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, username, start_balance, int(time.time()), int(time.time())))
+            if cursor.rowcount == 1:
+                # Стартовый баланс не проходит через журнал - он становится точкой отсчёта сверки
+                conn.execute('''
+                    INSERT OR REPLACE INTO reconcile_checkpoints (user_id, opening_balance, checked_version)
+                    VALUES (?, ?, 0)
+                ''', (user_id, start_balance))
+            return cursor.rowcount
+
+        with self.user_locks.hold(user_id):
+            self.touch(user_id)
             try:
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    INSERT OR IGNORE INTO users (user_id, username, balance, created_at, last_active)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, username, start_balance, datetime.now(), datetime.now()))
-                
-                conn.commit()
-                conn.close()
+                if self._write(insert) == 1:
+                    if self.wallet:
+                        self.wallet.create(user_id, start_balance)
+                    else:
+                        self.balances.set(user_id, start_balance, 0)
                 return True
             except sqlite3.Error as e:
                 print(f"Database error in add_user: {e}")
                 return False
-    
+
     def is_user_banned(self, user_id):
-        """Check on ban"""
-        with self.lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-        
+        """Check on ban (in-memory lookup)"""
         # Приводим user_id к строке или числу
         user_id_value = user_id.id if hasattr(user_id, 'id') else user_id
-        
-        cursor.execute("SELECT is_banned FROM users WHERE user_id = ?", (user_id_value,))
-        result = cursor.fetchone()
-        conn.close()
-        
-        return result['is_banned'] == 1 if result else False
-    
+
+        return user_id_value in self.banned
+
+    @read_only
+    def refresh_bans(self):
+        """Reload banned users set from database"""
+        changes = self.ban_changes
+        try:
+            with self.readers.connection() as conn:
+                rows = conn.execute('SELECT user_id FROM users WHERE is_banned = 1').fetchall()
+        except sqlite3.Error as e:
+            print(f"Database error in refresh_bans: {e}")
+            return False
+        with self.ban_lock:
+            # Бан через бота во время чтения снимок мог не увидеть - тогда перечитаем в следующий раз
+            if self.ban_changes == changes:
+                self.banned = {row['user_id'] for row in rows}
+        return True
+
+    def ban_user(self, user_id):
+        """Ban member"""
+        return self._set_banned(user_id, True)
+
+    def unban_user(self, user_id):
+        """Unban member"""
+        return self._set_banned(user_id, False)
+
+    def _set_banned(self, user_id, banned):
+        with self.write_lock:
+            try:
+                with self.writer.connection() as conn:
+                    cursor = conn.execute('UPDATE users SET is_banned = ? WHERE user_id = ?',
+                                          (1 if banned else 0, user_id))
+                    conn.commit()
+                if cursor.rowcount == 0:
+                    return False
+                with self.ban_lock:
+                    self.banned = self.banned | {user_id} if banned else self.banned - {user_id}
+                    self.ban_changes += 1
+                return True
+            except sqlite3.Error as e:
+                print(f"Database error in _set_banned: {e}")
+                return False
+
+    @read_only
     def get_balance(self, user_id):
         """Get balance member"""
-        with self.lock:
-            try:
-                conn = self.get_connection()
+        if self.wallet:
+            return self.wallet.get(user_id) or 0
+        cached = self.balances.get(user_id)
+        if cached is not None:
+            return cached
+
+        generation = self.balances.generation()
+        try:
+            with self.readers.connection() as conn:
                 cursor = conn.cursor()
-                
-                cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
+
+                cursor.execute('SELECT balance, version FROM users WHERE user_id = ?', (user_id,))
                 result = cursor.fetchone()
-                conn.close()
-                
-                return result['balance'] if result else 0
-            except sqlite3.Error as e:
-                print(f"Database error in get_balance: {e}")
+
+            if not result:
                 return 0
-    
+            # Пока читали, писатель мог обновить баланс - тогда прочитанное значение в кэш не кладём
+            self.balances.fill(user_id, result['balance'], result['version'], generation)
+            return result['balance']
+        except sqlite3.Error as e:
+            print(f"Database error in get_balance: {e}")
+            return 0
+
     def update_balance(self, user_id, amount):
         """Refresh balance (amount may be positive or negative)
         Return True if success, False if cost enought"""
-        with self.lock:
+        return self.change_balance(user_id, amount) is not None
+
+    def change_balance(self, user_id, amount):
+        """Add amount to balance with compare-and-swap on row version
+        Return new balance or None if balance would leave 0..MAX_BALANCE"""
+        with self.user_locks.hold(user_id):
             try:
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                
-                # Проверяем текущий баланс
-                cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-                result = cursor.fetchone()
-                
-                if not result:
-                    conn.close()
-                    return False
-                
-                current_balance = result['balance']
-                new_balance = current_balance + amount
-                
-                # Проверка на отрицательный баланс
-                if new_balance < 0:
-                    conn.close()
-                    return False
-                
-                # Защита от переполнения
-                if new_balance > 100000000:
-                    conn.close()
-                    return False
-                
-                cursor.execute('''
-                    UPDATE users 
-                    SET balance = ?, last_active = ?
-                    WHERE user_id = ?
-                ''', (new_balance, datetime.now(), user_id))
-                
-                conn.commit()
-                conn.close()
-                return True
+                if self.wallet:
+                    self.touch(user_id)
+                    return self.wallet.apply(user_id, amount)
+                result = self._write(lambda conn: self._apply_balance_delta(conn, user_id, amount))
+                if result is None:
+                    return None
+                return self._commit_balance(user_id, amount, result)
             except sqlite3.Error as e:
-                print(f"Database error in update_balance: {e}")
-                return False
-    
+                print(f"Database error in change_balance: {e}")
+                return None
+
+    def _apply_balance_delta(self, conn, user_id, amount):
+        """Compare-and-swap balance change inside current transaction
+        Returns (new balance, version) or None if balance would leave 0..MAX_BALANCE
+        Raises VersionConflict if another process changed the row after it was cached"""
+        # Активность отмечаем до коммита: сверка не тронет игрока, пока она не записана
+        self.touch(user_id)
+        entry = self._balance_entry(conn, user_id, amount)
+        if entry is None or not 0 <= entry[0] + amount <= MAX_BALANCE:
+            return None
+        if self.wallet:
+            # Баланс ведёт кошелёк: здесь только проверка, изменение - после коммита (_commit_balance)
+            return entry[0] + amount, None
+        if not self.wallet_released:
+            # Балансы меняются мимо кошелька - при следующем включении он заполнится из users
+            conn.execute('DELETE FROM wallet_state')
+
+        balance, version = entry
+        rows = conn.execute('''
+            UPDATE users
+            SET balance = ?, version = version + 1
+            WHERE user_id = ? AND version = ?
+            RETURNING balance, version
+        ''', (balance + amount, user_id, version)).fetchall()
+        if not rows:
+            self.balances.invalidate(user_id)
+            raise VersionConflict(f"Balance of user {user_id} was changed by another writer")
+        return rows[0]['balance'], rows[0]['version']
+
+    def _balance_entry(self, conn, user_id, amount=0):
+        """(balance, version) that a change by amount is checked against, None for unknown user
+        Taken from wallet or balance cache, read inside current transaction if the cache can't decide"""
+        if self.wallet:
+            balance = self.wallet.get(user_id)
+            return None if balance is None else (balance, None)
+        entry = self.balances.get_entry(user_id)
+        if entry is None or not 0 <= entry[0] + amount <= MAX_BALANCE:
+            # Нет в кэше, или кэш говорит "не хватает" - решение принимаем только по базе
+            row = conn.execute('SELECT balance, version FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            if row is None:
+                return None
+            entry = (row['balance'], row['version'])
+        return entry
+
+    def record_payment(self, charge_id, user_id, amount, payload=None):
+        """Credit paid stars once per telegram_payment_charge_id
+        Payment row, balance and ledger row are written in one transaction
+        Return (status, balance): PAYMENT_APPLIED, PAYMENT_DUPLICATE or the reason it was not credited -
+        PAYMENT_REJECTED (balance limit), PAYMENT_UNKNOWN_USER, PAYMENT_FAILED (database error)"""
+        rows = [(user_id, 'purchase', amount, 'buy_stars', datetime.now())]
+
+        def credit(conn):
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO payments (charge_id, user_id, amount, payload, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (charge_id, user_id, amount, payload, int(time.time())))
+            if cursor.rowcount == 0:
+                return PAYMENT_DUPLICATE, None
+            if self._balance_entry(conn, user_id) is None:
+                conn.rollback()
+                return PAYMENT_UNKNOWN_USER, None
+            result = self._apply_balance_delta(conn, user_id, amount)
+            if result is None:
+                conn.rollback()
+                return PAYMENT_REJECTED, None
+            # Строку журнала пишем в этой же транзакции и мимо буфера: поступившие деньги
+            # не должны теряться при сбое, а платежей мало
+            self._insert_transactions(conn, rows)
+            return PAYMENT_APPLIED, result
+
+        with self.user_locks.hold(user_id):
+            try:
+                # Быстрая проверка по уникальному индексу без блокировки записи
+                if self._is_payment_applied(charge_id):
+                    return PAYMENT_DUPLICATE, self.get_balance(user_id)
+                status, result = self._write(credit, rows)
+                if result is None:
+                    return status, self.get_balance(user_id)
+                return status, self._commit_balance(user_id, amount, result)
+            except sqlite3.Error as e:
+                print(f"Database error in record_payment: {e}")
+                return PAYMENT_FAILED, self.get_balance(user_id)
+
+    def _is_payment_applied(self, charge_id):
+        """Check whether payment with this charge id was already credited"""
+        with self.readers.connection() as conn:
+            return conn.execute('SELECT 1 FROM payments WHERE charge_id = ?', (charge_id,)).fetchone() is not None
+
+    @read_only
+    def is_payment_applied(self, charge_id):
+        """True/False, or None if database could not be read"""
+        try:
+            return self._is_payment_applied(charge_id)
+        except sqlite3.Error as e:
+            print(f"Database error in is_payment_applied: {e}")
+            return None
+
     def add_transaction(self, user_id, game_type, amount, transaction_type):
         """Writing transaction"""
-        with self.lock:
-            try:
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    INSERT INTO transactions (user_id, game_type, amount, transaction_type, timestamp)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, game_type, amount, transaction_type, datetime.now()))
-                
+        row = (user_id, game_type, amount, transaction_type, datetime.now())
+        if self.ledger:
+            self.ledger.append([row])
+            return True
+
+        try:
+            self._write(lambda conn: self._insert_transactions(conn, [row]), [row])
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error in add_transaction: {e}")
+            return False
+
+    def _insert_transactions(self, conn, rows):
+        """Insert ledger rows (user_id, game_type, amount, transaction_type, timestamp)
+        into monthly partitions and add them to rollup tables in the same transaction"""
+        if not rows:
+            return
+        last_id = conn.execute('''
+            UPDATE ledger_sequence SET last_id = last_id + ? RETURNING last_id
+        ''', (len(rows),)).fetchall()[0][0]
+        first_id = last_id - len(rows) + 1
+
+        by_partition = {}
+        for offset, (user_id, game_type, amount, transaction_type, timestamp) in enumerate(rows):
+            name = self._partition_for(conn, timestamp)
+            by_partition.setdefault(name, []).append((
+                first_id + offset, user_id, self._type_code(conn, 'game', game_type), amount,
+                self._type_code(conn, 'transaction', transaction_type), _to_epoch(timestamp)))
+
+        for name, partition_rows in by_partition.items():
+            conn.executemany(f'''
+                INSERT INTO {name} ({LEDGER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)
+            ''', partition_rows)
+        self._update_rollups(conn, rows)
+
+    def _update_rollups(self, conn, rows):
+        for table, period_format in ROLLUP_PERIODS.values():
+            totals = {}
+            for _, game_type, amount, transaction_type, timestamp in rows:
+                key = (timestamp.strftime(period_format), game_type, transaction_type)
+                count, total = totals.get(key, (0, 0))
+                totals[key] = (count + 1, total + amount)
+
+            conn.executemany(f'''
+                INSERT INTO {table} (period, game_type, transaction_type, tx_count, total_amount)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(period, game_type, transaction_type) DO UPDATE SET
+                    tx_count = tx_count + excluded.tx_count,
+                    total_amount = total_amount + excluded.total_amount
+            ''', [key + value for key, value in totals.items()])
+
+    @read_only
+    def get_rollups(self, period='day', since=None, until=None, game_type=None):
+        """Aggregated ledger [(period, game_type, transaction_type, tx_count, total_amount), ...]
+        since/until are datetimes, until is exclusive"""
+        table, period_format = ROLLUP_PERIODS[period]
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append('period >= ?')
+            params.append(since.strftime(period_format))
+        if until is not None:
+            conditions.append('period < ?')
+            params.append(until.strftime(period_format))
+        if game_type is not None:
+            conditions.append('game_type = ?')
+            params.append(game_type)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        try:
+            pending = []
+            with self.readers.connection() as conn:
+                # Строки из буфера журнала досчитываем в памяти, не дожидаясь их записи
+                with self.ledger.visibility if self.ledger else nullcontext():
+                    if self.ledger:
+                        pending = self.ledger.pending()
+                    rows = conn.execute(f'''
+                        SELECT period, game_type, transaction_type, tx_count, total_amount
+                        FROM {table} {where}
+                    ''', params).fetchall()
+
+            totals = {tuple(row[:3]): [row[3], row[4]] for row in rows}
+            for _, row_game, amount, transaction_type, timestamp in pending:
+                key = (timestamp.strftime(period_format), row_game, transaction_type)
+                if ((since is not None and key[0] < since.strftime(period_format))
+                        or (until is not None and key[0] >= until.strftime(period_format))
+                        or (game_type is not None and row_game != game_type)):
+                    continue
+                total = totals.setdefault(key, [0, 0])
+                total[0] += 1
+                total[1] += amount
+            return [key + tuple(total) for key, total in sorted(totals.items())]
+        except sqlite3.Error as e:
+            print(f"Database error in get_rollups: {e}")
+            return []
+
+    def backfill_rollups(self, chunk_size=10000, progress=None):
+        """Rebuild rollup tables from active ledger partitions
+        Works in small chunks so the bot keeps writing in between"""
+        self.flush_ledger()
+        with self.write_lock, self.writer.connection() as conn:
+            # Сводки по отсоединённым партициям не трогаем - их строк уже нет в базе
+            first_month = min(self.partitions)
+            since = datetime.strptime(first_month, '%Y%m').strftime('%Y-%m-%d')
+            # Всё, что новее last_id, досчитают обычные вставки
+            for table, _ in ROLLUP_PERIODS.values():
+                conn.execute(f'DELETE FROM {table} WHERE period >= ?', (since,))
+            # Полный пересчёт заменяет назначенный миграцией фоновый
+            conn.execute("DELETE FROM schema_backfills WHERE name = 'rollups'")
+            last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+            conn.commit()
+
+        done_id = 0
+        while done_id < last_id:
+            upper_id = min(done_id + chunk_size, last_id)
+            with self.write_lock, self.writer.connection() as conn:
+                self._add_rollups(conn, done_id, upper_id)
                 conn.commit()
-                conn.close()
-                return True
-            except sqlite3.Error as e:
-                print(f"Database error in add_transaction: {e}")
+            done_id = upper_id
+            if progress:
+                progress(done_id, last_id)
+        return last_id
+
+    def _add_rollups(self, conn, after_id, upper_id):
+        """Add ledger rows with ids in (after_id, upper_id] to rollup tables"""
+        for table, period_format in ROLLUP_PERIODS.values():
+            conn.execute(f'''
+                INSERT INTO {table} (period, game_type, transaction_type, tx_count, total_amount)
+                SELECT strftime(?, t.timestamp, 'unixepoch', 'localtime'), g.name, k.name,
+                       COUNT(*), SUM(t.amount)
+                FROM transactions t
+                JOIN type_codes g ON g.kind = 'game' AND g.code = t.game_type
+                JOIN type_codes k ON k.kind = 'transaction' AND k.code = t.transaction_type
+                WHERE t.id > ? AND t.id <= ?
+                GROUP BY 1, 2, 3
+                ON CONFLICT(period, game_type, transaction_type) DO UPDATE SET
+                    tx_count = tx_count + excluded.tx_count,
+                    total_amount = total_amount + excluded.total_amount
+            ''', (period_format, after_id, upper_id))
+
+    def _stage_ledger(self, conn, rows):
+        """Write ledger rows in current transaction
+        With write-behind enabled return them to be buffered after commit"""
+        if self.ledger:
+            return rows
+        self._insert_transactions(conn, rows)
+        return []
+
+    def _write_ledger_rows(self, rows, commit=None):
+        """Flush batch of buffered ledger rows with one commit"""
+        self._write(lambda conn: self._insert_transactions(conn, rows), rows, commit=commit)
+
+    def flush_ledger(self):
+        """Write buffered ledger rows now"""
+        if self.ledger:
+            self.ledger.flush()
+
+    @read_only
+    def get_transactions(self, user_id, before_id=None, limit=20):
+        """Page of member transactions, newest first
+        Pass id of the last row as before_id to get the next page
+        Old months are read from compressed archive when the page reaches them.
+        Rows still in the write-behind buffer open the first page with id None"""
+        first_page = before_id is None
+        if before_id is None:
+            before_id = 2 ** 63 - 1
+        try:
+            for attempt in range(2):
+                rows = []
+                pending = []
+                with self.readers.connection() as conn:
+                    try:
+                        # Буфер журнала читаем вместе с базой, не дожидаясь его записи
+                        with self.ledger.visibility if self.ledger and first_page else nullcontext():
+                            if self.ledger and first_page:
+                                pending = self.ledger.pending(user_id)
+                            # id сквозные, поэтому берём до limit строк из каждой партиции и сливаем
+                            for name in self._partitions_in_range():
+                                rows.extend(conn.execute(f'''
+                                    SELECT id, game_type, amount, transaction_type, timestamp
+                                    FROM {name}
+                                    WHERE user_id = ? AND id < ?
+                                    ORDER BY id DESC
+                                    LIMIT ?
+                                ''', (user_id, before_id, limit)).fetchall())
+                        break
+                    except sqlite3.OperationalError as e:
+                        # Партицию убрал другой процесс бота - перечитываем каталог, месяц уже в архиве
+                        if attempt or not self._reload_partitions(conn, e):
+                            raise
+
+            rows.sort(key=lambda row: row['id'], reverse=True)
+            page = [(None, game_type, amount, transaction_type, timestamp.strftime(TIMESTAMP_FORMAT))
+                    for _, game_type, amount, transaction_type, timestamp in reversed(pending)]
+            page.extend((row['id'], self._type_name('game', row['game_type']), row['amount'],
+                         self._type_name('transaction', row['transaction_type']),
+                         _from_epoch(row['timestamp'])) for row in rows)
+            page = page[:limit]
+
+            for month in reversed(self.archived_months):
+                if len(page) >= limit:
+                    break
+                archived = self.archive.read_user(month, user_id, before_id, limit - len(page))
+                page.extend(row[:1] + row[2:] for row in archived)
+            return page
+        except sqlite3.Error as e:
+            print(f"Database error in get_transactions: {e}")
+            return []
+
+    def reconcile(self, chunk_size=None, duty_cycle=None, progress=None):
+        """Verify users.balance against ledger rows added since the last checkpoint
+
+        Ledger rows are summed per user in id chunks of chunk_size; once the scan has caught up
+        with the ledger, accounts whose balance changed since the last check are compared with
+        opening_balance + ledger_sum. Accounts active during the last reconcile_settle seconds or
+        whose row version changed since the previous pass wait for a later pass (write-behind
+        ledger rows and coalesced last_active may lag behind the balance). Between chunks
+        the job sleeps so that it works only duty_cycle of the time
+        Returns report dict or None if another pass is already running"""
+        chunk_size = chunk_size or self.reconcile_chunk_size
+        duty_cycle = duty_cycle or self.reconcile_duty_cycle
+        if not self.reconcile_lock.acquire(blocking=False):
+            return None
+        try:
+            started = time.perf_counter()
+            report = {'rows': 0, 'checked': 0, 'baselined': 0, 'drifting': [], 'last_id': 0}
+            self.flush_ledger()
+            self.flush_activity()
+            while not self.closed:
+                step_started = time.perf_counter()
+                done = self._reconcile_step(chunk_size, report)
+                if progress:
+                    progress(report['last_id'], report['rows'])
+                if done:
+                    break
+                # Бюджет CPU и диска: после шага длиной t отдыхаем t * (1 - d) / d
+                if duty_cycle < 1:
+                    time.sleep((time.perf_counter() - step_started) * (1 - duty_cycle) / duty_cycle)
+
+            report['seconds'] = time.perf_counter() - started
+            stats = self.reconcile_stats
+            stats['passes'] += 1
+            stats['rows'] += report['rows']
+            stats['checked'] += report['checked']
+            stats['baselined'] += report['baselined']
+            stats['last_id'] = report['last_id']
+            stats['last_seconds'] = report['seconds']
+            stats['drifting'] = len(self.get_drifting_accounts())
+            return report
+        except sqlite3.Error as e:
+            print(f"Database error in reconcile: {e}")
+            return None
+        finally:
+            self.reconcile_lock.release()
+
+    def _reconcile_step(self, chunk_size, report):
+        """Sum one chunk of ledger rows per user and, if it was the last one, compare balances
+        Returns True when the ledger is fully verified"""
+        debit_codes = [self.type_codes['transaction'][name] for name in DEBIT_TRANSACTION_TYPES
+                       if name in self.type_codes['transaction']]
+        debit = ', '.join('?' * len(debit_codes)) or 'NULL'
+        now = int(time.time())
+
+        with self.readers.connection() as conn:
+            # Журнал и балансы читаем из одного снимка
+            conn.execute('BEGIN')
+            try:
+                cursor_id = conn.execute('SELECT last_id FROM reconcile_state').fetchone()[0]
+                head_id = conn.execute('SELECT last_id FROM ledger_sequence').fetchone()[0]
+                upper_id = min(cursor_id + chunk_size, head_id)
+                # user_id -> (сумма со знаком, последняя строка, число строк)
+                deltas = {row[0]: tuple(row[1:]) for row in conn.execute(f'''
+                    SELECT user_id,
+                           SUM(CASE WHEN transaction_type IN ({debit}) THEN -amount ELSE amount END),
+                           MAX(id), COUNT(*)
+                    FROM transactions
+                    WHERE id > ? AND id <= ?
+                    GROUP BY user_id
+                ''', (*debit_codes, cursor_id, upper_id))}
+                done = upper_id == head_id
+                candidates = self._reconcile_candidates(conn, deltas, now - self.reconcile_settle) if done else []
+            finally:
+                conn.rollback()
+
+        checkpoints = []
+        seen = []
+        for row in candidates:
+            user_id, balance, version = row['user_id'], row['balance'], row['version']
+            if self.activity.is_pending(user_id):
+                continue
+            if row['seen_version'] != version:
+                # Баланс менялся с прошлого прохода (возможно, другим процессом) - ждём, пока успокоится
+                seen.append((user_id, version, now))
+                continue
+            if now - row['seen_at'] < self.reconcile_settle:
+                continue
+            total = (row['ledger_sum'] or 0) + deltas.get(user_id, (0,))[0]
+            if row['opening_balance'] is None:
+                # Игрок старше сверки: текущий баланс становится точкой отсчёта
+                checkpoints.append((user_id, balance - total, version, now, 0))
+                report['baselined'] += 1
+                continue
+            report['checked'] += 1
+            drift = balance - row['opening_balance'] - total
+            if drift != 0:
+                report['drifting'].append((user_id, balance, balance - drift, drift))
+                if drift != row['drift']:
+                    print(f"Ledger drift: user {user_id} balance {balance}, ledger {balance - drift}")
+            checkpoints.append((user_id, None, version, now, drift))
+
+        def save(conn):
+            # Другой процесс бота успел сверить этот же кусок журнала
+            if conn.execute('UPDATE reconcile_state SET last_id = ? WHERE last_id = ?',
+                            (upper_id, cursor_id)).rowcount == 0:
+                conn.rollback()
                 return False
-    
+            conn.executemany('''
+                INSERT INTO reconcile_checkpoints (user_id, last_id, ledger_sum) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    last_id = MAX(last_id, excluded.last_id),
+                    ledger_sum = ledger_sum + excluded.ledger_sum
+            ''', [(user_id, last_id, amount) for user_id, (amount, last_id, _) in deltas.items()])
+            conn.executemany('''
+                INSERT INTO reconcile_checkpoints (user_id, opening_balance, checked_version, checked_at, drift)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    opening_balance = COALESCE(opening_balance, excluded.opening_balance),
+                    checked_version = excluded.checked_version,
+                    checked_at = excluded.checked_at,
+                    drift = excluded.drift
+            ''', checkpoints)
+            conn.executemany('''
+                INSERT INTO reconcile_checkpoints (user_id, seen_version, seen_at) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    seen_version = excluded.seen_version,
+                    seen_at = excluded.seen_at
+            ''', seen)
+            return True
+
+        if not self._write(save):
+            return True
+        report['rows'] += sum(count for _, _, count in deltas.values())
+        report['last_id'] = upper_id
+        return done
+
+    def _reconcile_candidates(self, conn, deltas, quiet_since):
+        """Accounts to compare: new or changed since the last check, drifting, or with new ledger rows
+        Only accounts idle since quiet_since are taken: their buffered ledger rows are already written"""
+        columns = '''
+            SELECT u.user_id, u.balance, u.version, c.opening_balance, c.ledger_sum, c.drift,
+                   c.seen_version, c.seen_at
+            FROM users u
+            LEFT JOIN reconcile_checkpoints c ON c.user_id = u.user_id
+        '''
+        rows = {row['user_id']: row for row in conn.execute(columns + '''
+            WHERE u.last_active <= ?
+              AND (c.user_id IS NULL OR c.opening_balance IS NULL
+                   OR u.version != c.checked_version OR c.drift != 0)
+        ''', (quiet_since,))}
+        # Строки журнала без изменения баланса (add_transaction) тоже должны всплыть
+        missing = [user_id for user_id in deltas if user_id not in rows]
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            rows.update((row['user_id'], row) for row in conn.execute(
+                columns + f"WHERE u.last_active <= ? AND u.user_id IN ({', '.join('?' * len(chunk))})",
+                (quiet_since, *chunk)))
+        return list(rows.values())
+
+    @read_only
+    def get_drifting_accounts(self):
+        """Accounts whose balance disagrees with the ledger [(user_id, balance, ledger balance, drift), ...]"""
+        with self.readers.connection() as conn:
+            rows = conn.execute('''
+                SELECT c.user_id, u.balance, c.drift
+                FROM reconcile_checkpoints c
+                JOIN users u ON u.user_id = c.user_id
+                WHERE c.drift != 0
+                ORDER BY c.user_id
+            ''').fetchall()
+        return [(row['user_id'], row['balance'], row['balance'] - row['drift'], row['drift']) for row in rows]
+
+    def iter_ledger(self, since=None, until=None, user_id=None, game_type=None, batch_size=1000):
+        """Stream ledger rows (id, user_id, game_type, amount, transaction_type, timestamp)
+        from partitions covering [since, until), oldest first"""
+        self.flush_ledger()
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            params.append(_to_epoch(since))
+        if until is not None:
+            conditions.append('timestamp < ?')
+            params.append(_to_epoch(until))
+        if user_id is not None:
+            conditions.append('user_id = ?')
+            params.append(user_id)
+        if game_type is not None:
+            # Незнакомой игры в партициях нет: код -1 не совпадёт ни с одной строкой
+            conditions.append('game_type = ?')
+            params.append(self.type_codes['game'].get(game_type, -1))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        # Архивные месяцы старше активных партиций, поэтому идут первыми
+        for month in _months_in_range(self.archived_months, since, until):
+            yield from self._iter_archived_month(month, since, until, user_id, game_type)
+
+        with self.readers.connection() as conn:
+            partitions = self.partitions
+            for month in _months_in_range(partitions, since, until):
+                try:
+                    cursor = conn.execute(
+                        f'SELECT {LEDGER_COLUMNS} FROM {partitions[month]} {where} ORDER BY timestamp, id',
+                        params)
+                except sqlite3.OperationalError as e:
+                    # Партицию убрал другой процесс бота: архивный месяц дочитываем из архива
+                    if not self._reload_partitions(conn, e):
+                        raise
+                    if month in self.archived_months:
+                        yield from self._iter_archived_month(month, since, until, user_id, game_type)
+                    continue
+                while True:
+                    batch = cursor.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    for row in batch:
+                        yield self._decode_ledger_row(row)
+
+    def _iter_archived_month(self, month, since, until, user_id, game_type):
+        """Archived rows of one month matching iter_ledger filters"""
+        for row in self.archive.iter_rows(month):
+            if since is not None and row[5] < str(since):
+                continue
+            if until is not None and row[5] >= str(until):
+                continue
+            if user_id is not None and row[1] != user_id:
+                continue
+            if game_type is not None and row[2] != game_type:
+                continue
+            yield row
+
     def update_game_stats(self, user_id, game_type, won, bet_amount, win_amount):
         """Refresh Game Statistic"""
-        with self.lock:
+        if self.stats_buffer:
+            self.stats_buffer.add(user_id, game_type, won, bet_amount, win_amount)
+            self.leaderboard.record(user_id, game_type, won, bet_amount, win_amount)
+            return True
+
+        with self.user_locks.hold(user_id):
             try:
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    INSERT INTO game_stats (user_id, game_type, games_played, games_won, total_bet, total_won)
-                    VALUES (?, ?, 1, ?, ?, ?)
-                    ON CONFLICT(user_id, game_type) DO UPDATE SET
-                        games_played = games_played + 1,
-                        games_won = games_won + ?,
-                        total_bet = total_bet + ?,
-                        total_won = total_won + ?
-                ''', (user_id, game_type, 1 if won else 0, bet_amount, win_amount, 
-                      1 if won else 0, bet_amount, win_amount))
-                
-                conn.commit()
-                conn.close()
+                self._write(lambda conn: self._upsert_game_stats(
+                    conn, user_id, game_type, won, bet_amount, win_amount), game_types=[game_type])
+                self.leaderboard.record(user_id, game_type, won, bet_amount, win_amount)
                 return True
             except sqlite3.Error as e:
                 print(f"Database error in update_game_stats: {e}")
                 return False
-    
-    def get_user_stats(self, user_id):
-        """Get Members Statistic"""
-        with self.lock:
+
+    def _upsert_game_stats(self, conn, user_id, game_type, won, bet_amount, win_amount):
+        """Add one round to game_stats inside current transaction"""
+        self._add_game_stats(conn, [(user_id, game_type, 1, 1 if won else 0, bet_amount, win_amount)])
+
+    def _add_game_stats(self, conn, rows):
+        """Add deltas (user_id, game_type, played, won, bet, won amount) to game_stats"""
+        conn.executemany('''
+            INSERT INTO game_stats (user_id, game_type, games_played, games_won, total_bet, total_won)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, game_type) DO UPDATE SET
+                games_played = games_played + excluded.games_played,
+                games_won = games_won + excluded.games_won,
+                total_bet = total_bet + excluded.total_bet,
+                total_won = total_won + excluded.total_won
+        ''', [(user_id, self._type_code(conn, 'game', game_type), *delta)
+              for user_id, game_type, *delta in rows])
+
+    def _write_game_stats(self, rows, commit=None):
+        """Flush batch of buffered game_stats deltas with one commit"""
+        self._write(lambda conn: self._add_game_stats(conn, rows), game_types={row[1] for row in rows},
+                    commit=commit)
+
+    def place_bet(self, user_id, game_type, bet):
+        """Take bet for multi-step game (balance + ledger row in one transaction)
+        Return new balance or None if cost enought"""
+        rows = [(user_id, game_type, bet, 'bet', datetime.now())]
+
+        def take_bet(conn):
+            result = self._apply_balance_delta(conn, user_id, -bet)
+            if result is None:
+                # conn is None на пути кошелька без транзакции SQLite
+                if conn is not None:
+                    conn.rollback()
+                return None, []
+            return result, self._stage_ledger(conn, rows)
+
+        with self.user_locks.hold(user_id):
             try:
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    SELECT game_type, games_played, games_won, total_bet, total_won
-                    FROM game_stats
-                    WHERE user_id = ?
-                ''', (user_id,))
-                
-                stats = cursor.fetchall()
-                conn.close()
-                
-                return [(row['game_type'], row['games_played'], row['games_won'], 
-                        row['total_bet'], row['total_won']) for row in stats]
+                if self.wallet and self.ledger:
+                    # Кошелёк и отложенный журнал: транзакция SQLite не нужна
+                    result, staged = take_bet(None)
+                else:
+                    result, staged = self._write(take_bet, rows)
+                if result is None:
+                    return None
+                new_balance = self._commit_balance(user_id, -bet, result)
+                if staged:
+                    self.ledger.append(staged)
+                return new_balance
             except sqlite3.Error as e:
-                print(f"Database error in get_user_stats: {e}")
-                return []
+                print(f"Database error in place_bet: {e}")
+                return None
+
+    def settle_round(self, user_id, game_type, bet, win, won, bet_placed=False):
+        """Settle game round: balance, bet/win ledger rows and game stats
+        Without write-behind buffers all three are written in one transaction. With them only
+        the balance is applied here (or in the wallet); ledger rows and game stats are handed to
+        LedgerWriter/StatsAggregator after it and reach SQLite in their next batch, within
+        their flush interval (readers already see them merged from the buffers).
+        bet_placed=True if bet was already taken by place_bet, otherwise the balance must cover it.
+        Win above MAX_BALANCE is cut off, the round itself is never voided
+        Return new balance or None if cost enought"""
+        now = datetime.now()
+        stake = 0 if bet_placed else bet
+        # Строки до среза выигрыша - по ним заранее готовятся партиция и коды типов
+        planned = [(user_id, game_type, bet, 'bet', now), (user_id, game_type, win, 'win', now)]
+
+        def settle(conn):
+            entry = self._balance_entry(conn, user_id, -stake)
+            if entry is None or entry[0] < stake:
+                return None
+            # Ставка уже сыграна - лишнее сверх лимита баланса не начисляем, а не отменяем раунд
+            paid = min(win, MAX_BALANCE - entry[0] + stake)
+            result = self._apply_balance_delta(conn, user_id, paid - stake)
+            if result is None:
+                # conn is None, когда всё отложено и транзакции SQLite нет
+                if conn is not None:
+                    conn.rollback()
+                return None
+            rows = []
+            if stake:
+                rows.append((user_id, game_type, stake, 'bet', now))
+            if paid > 0:
+                rows.append((user_id, game_type, paid, 'win', now))
+            staged = self._stage_ledger(conn, rows)
+            if not self.stats_buffer:
+                self._upsert_game_stats(conn, user_id, game_type, won, bet, paid)
+            return result, paid, staged
+
+        with self.user_locks.hold(user_id):
+            try:
+                if self.wallet and self.ledger and self.stats_buffer:
+                    # Всё отложенное: транзакция SQLite не нужна
+                    outcome = settle(None)
+                else:
+                    outcome = self._write(settle, planned, [game_type])
+                if outcome is None:
+                    return None
+                result, paid, staged = outcome
+                new_balance = self._commit_balance(user_id, paid - stake, result)
+                if self.stats_buffer:
+                    self.stats_buffer.add(user_id, game_type, won, bet, paid)
+                self.leaderboard.record(user_id, game_type, won, bet, paid)
+                if staged:
+                    self.ledger.append(staged)
+                return new_balance
+            except sqlite3.Error as e:
+                print(f"Database error in settle_round: {e}")
+                return None
+
+    @read_only
+    def get_user_stats(self, user_id):
+        """Get Members Statistic (with rounds not yet written by the stats buffer)"""
+        try:
+            pending = {}
+            with self.readers.connection() as conn:
+                # Под visibility пачка буфера не закоммитится между чтением дельт и SELECT
+                with self.stats_buffer.visibility if self.stats_buffer else nullcontext():
+                    if self.stats_buffer:
+                        pending = self.stats_buffer.pending_for(user_id)
+                    stats = conn.execute('''
+                        SELECT c.name AS game_type, s.games_played, s.games_won, s.total_bet, s.total_won
+                        FROM game_stats s
+                        JOIN type_codes c ON c.kind = 'game' AND c.code = s.game_type
+                        WHERE s.user_id = ?
+                    ''', (user_id,)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Database error in get_user_stats: {e}")
+            return []
+
+        result = []
+        for row in stats:
+            delta = pending.pop(row['game_type'], (0, 0, 0, 0))
+            result.append((row['game_type'], row['games_played'] + delta[0], row['games_won'] + delta[1],
+                           row['total_bet'] + delta[2], row['total_won'] + delta[3]))
+        result.extend((game_type, *delta) for game_type, delta in pending.items())
+        return result
+
+    def load_leaderboard(self):
+        """Rebuild in-memory leaderboards from game_stats"""
+        try:
+            with self.readers.connection() as conn:
+                rows = conn.execute('''
+                    SELECT s.user_id, c.name, s.games_won, s.total_bet, s.total_won
+                    FROM game_stats s
+                    JOIN type_codes c ON c.kind = 'game' AND c.code = s.game_type
+                ''').fetchall()
+            self.leaderboard.load(tuple(row) for row in rows)
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error in load_leaderboard: {e}")
+            return False
+
+    @read_only
+    def get_leaderboard(self, game_type=OVERALL, metric='profit', limit=None):
+        """Top players as [(user_id, username, value), ...]"""
+        top = self.leaderboard.top(game_type, metric, limit)
+        if not top:
+            return []
+
+        try:
+            with self.readers.connection() as conn:
+                placeholders = ','.join('?' * len(top))
+                rows = conn.execute(f'''
+                    SELECT user_id, username FROM users WHERE user_id IN ({placeholders})
+                ''', [user_id for user_id, _ in top]).fetchall()
+            names = {row['user_id']: row['username'] for row in rows}
+        except sqlite3.Error as e:
+            print(f"Database error in get_leaderboard: {e}")
+            names = {}
+
+        return [(user_id, names.get(user_id), value) for user_id, value in top]
+
+
+def _to_epoch(moment):
+    """Datetime -> integer epoch seconds stored in database"""
+    return int(moment.timestamp())
+
+
+def _from_epoch(value):
+    """Stored epoch seconds -> local time text returned to callers"""
+    return datetime.fromtimestamp(value).strftime(TIMESTAMP_FORMAT) if value is not None else None
+
+
+def _column_type(conn, table, column):
+    """Declared type of table column or None if there is no such table/column"""
+    for row in conn.execute(f'PRAGMA table_info({table})'):
+        if row['name'] == column:
+            return row['type'].upper()
+    return None
+
+
+def _month_key(moment):
+    """Partition key YYYYMM for datetime"""
+    return moment.strftime('%Y%m')
+
+
+def _next_month(moment):
+    """First day of the month after moment"""
+    return (moment.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0,
+                                                               second=0, microsecond=0)
+
+
+def _months_in_range(months, since=None, until=None):
+    """Months YYYYMM overlapping [since, until), oldest first"""
+    first = _month_key(since) if since is not None else None
+    last = _month_key(until - timedelta(microseconds=1)) if until is not None else None
+    return [month for month in sorted(months)
+            if (first is None or month >= first) and (last is None or month <= last)]
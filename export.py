@@ -0,0 +1,186 @@
+import csv
+import functools
+import json
+import struct
+import sys
+import time
+from array import array
+from datetime import datetime
+
+# Колоночный файл журнала:
+#   MAGIC | группы строк (по колонке подряд: сырые little-endian массивы) | футер JSON | длина футера | MAGIC
+# Футер хранит схему, словари для строковых колонок и смещения каждой колонки каждой группы,
+# поэтому колонку можно загрузить целиком, например numpy.frombuffer(..., dtype='<i8')
+MAGIC = b'LEDGCOL1'
+FOOTER_SIZE = struct.Struct('<Q')
+
+# Колонки iter_ledger: имя, тип array, строковая колонка кодируется словарём
+COLUMNS = (
+    ('id', 'q', False),
+    ('user_id', 'q', False),
+    ('game_type', 'H', True),
+    ('amount', 'q', False),
+    ('transaction_type', 'H', True),
+    ('timestamp', 'q', False),
+)
+CSV_HEADER = [name for name, _, _ in COLUMNS]
+
+
+class ExportProgress:
+    """Counts streamed rows and reports rows/sec every report_every rows"""
+
+    def __init__(self, report=None, report_every=100000):
+        self.report = report
+        self.report_every = report_every
+        self.rows = 0
+        self.started = time.perf_counter()
+
+    def track(self, rows):
+        """Pass rows through, counting them"""
+        for row in rows:
+            self.rows += 1
+            if self.report and self.rows % self.report_every == 0:
+                self.report(self.rows, self.rows_per_sec())
+            yield row
+
+    def seconds(self):
+        return time.perf_counter() - self.started
+
+    def rows_per_sec(self):
+        seconds = self.seconds()
+        return self.rows / seconds if seconds else 0
+
+
+def write_csv(rows, path):
+    """Stream ledger rows into CSV file, returns number of rows"""
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+@functools.lru_cache(maxsize=4096)
+def _epoch(timestamp):
+    # Строки идут по времени, поэтому одна и та же секунда разбирается один раз
+    return int(datetime.strptime(timestamp[:19], '%Y-%m-%d %H:%M:%S').timestamp())
+
+
+def write_columnar(rows, path, row_group_size=65536):
+    """Stream ledger rows into columnar file in row groups of row_group_size
+    Memory use is bounded by one row group. Returns number of rows"""
+    dictionaries = {name: {} for name, _, encoded in COLUMNS if encoded}
+    groups = []
+    count = 0
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        group = _new_group()
+        for row in rows:
+            for (name, _, encoded), value, column in zip(COLUMNS, row, group):
+                if encoded:
+                    value = dictionaries[name].setdefault(value, len(dictionaries[name]))
+                elif name == 'timestamp':
+                    value = _epoch(value)
+                column.append(value)
+            count += 1
+            if len(group[0]) >= row_group_size:
+                groups.append(_write_group(f, group))
+                group = _new_group()
+        if len(group[0]):
+            groups.append(_write_group(f, group))
+
+        footer = json.dumps({
+            'columns': [{'name': name, 'type': typecode, 'dictionary': encoded}
+                        for name, typecode, encoded in COLUMNS],
+            'byteorder': 'little',
+            'timestamp': 'epoch seconds',
+            'dictionaries': {name: list(values) for name, values in dictionaries.items()},
+            'rows': count,
+            'row_groups': groups,
+        }, separators=(',', ':')).encode('utf-8')
+        f.write(footer)
+        f.write(FOOTER_SIZE.pack(len(footer)))
+        f.write(MAGIC)
+    return count
+
+
+def _new_group():
+    return [array(typecode) for _, typecode, _ in COLUMNS]
+
+
+def _write_group(f, group):
+    chunks = []
+    for column in group:
+        if sys.byteorder != 'little':
+            column.byteswap()
+        offset = f.tell()
+        column.tofile(f)
+        chunks.append([offset, f.tell() - offset])
+    return {'rows': len(group[0]), 'columns': chunks}
+
+
+def read_footer(path):
+    """Footer of columnar file (schema, dictionaries, row groups)"""
+    with open(path, 'rb') as f:
+        f.seek(-(FOOTER_SIZE.size + len(MAGIC)), 2)
+        (length,) = FOOTER_SIZE.unpack(f.read(FOOTER_SIZE.size))
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a ledger columnar file")
+        f.seek(-(FOOTER_SIZE.size + len(MAGIC) + length), 2)
+        return json.loads(f.read(length))
+
+
+def iter_row_groups(path, columns=None):
+    """Row groups of columnar file as {column name: array}, only requested columns are read"""
+    footer = read_footer(path)
+    schema = footer['columns']
+    wanted = [index for index, column in enumerate(schema) if columns is None or column['name'] in columns]
+    with open(path, 'rb') as f:
+        for group in footer['row_groups']:
+            arrays = {}
+            for index in wanted:
+                offset, length = group['columns'][index]
+                f.seek(offset)
+                values = array(schema[index]['type'])
+                values.frombytes(f.read(length))
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                arrays[schema[index]['name']] = values
+            yield arrays
+
+
+def iter_columnar_rows(path):
+    """Rows of columnar file decoded back to iter_ledger form"""
+    footer = read_footer(path)
+    dictionaries = footer['dictionaries']
+    for arrays in iter_row_groups(path):
+        columns = []
+        for name, _, encoded in COLUMNS:
+            values = arrays[name]
+            if encoded:
+                values = [dictionaries[name][code] for code in values]
+            elif name == 'timestamp':
+                values = [datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S') for value in values]
+            columns.append(values)
+        yield from zip(*columns)
+
+
+WRITERS = {
+    'csv': write_csv,
+    'columnar': write_columnar,
+}
+
+
+def export_ledger(db, path, fmt='csv', since=None, until=None, user_id=None, game_type=None,
+                  batch_size=1000, report=None):
+    """Stream ledger from database into file
+    Returns (rows, seconds, rows_per_sec)"""
+    progress = ExportProgress(report)
+    rows = db.iter_ledger(since=since, until=until, user_id=user_id, game_type=game_type,
+                          batch_size=batch_size)
+    count = WRITERS[fmt](progress.track(rows), path)
+    return count, progress.seconds(), progress.rows_per_sec()
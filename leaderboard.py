@@ -0,0 +1,84 @@
+import threading
+
+# Доска по всем играм сразу
+OVERALL = "all"
+METRICS = ("profit", "wins")
+
+
+class Leaderboard:
+    """Top-N players per game_type and overall (by profit and by wins)
+    Kept in memory and updated incrementally on every round"""
+
+    def __init__(self, size=10):
+        self.size = size
+        self._lock = threading.Lock()
+        # game_type -> {user_id: {'wins': ..., 'profit': ...}}
+        self._totals = {}
+        # (game_type, metric) -> [(value, user_id), ...] sorted best first
+        self._top = {}
+        self.rebuilds = 0
+
+    def load(self, rows):
+        """Rebuild from game_stats rows (user_id, game_type, games_won, total_bet, total_won)"""
+        totals = {}
+        for user_id, game_type, games_won, total_bet, total_won in rows:
+            for key in (game_type, OVERALL):
+                entry = totals.setdefault(key, {}).setdefault(user_id, {'wins': 0, 'profit': 0})
+                entry['wins'] += games_won
+                entry['profit'] += total_won - total_bet
+
+        with self._lock:
+            self._totals = totals
+            self._top = {}
+            for game_type in totals:
+                for metric in METRICS:
+                    self._rebuild(game_type, metric)
+
+    def record(self, user_id, game_type, won, bet_amount, win_amount):
+        """Apply one round result"""
+        with self._lock:
+            for key in (game_type, OVERALL):
+                entry = self._totals.setdefault(key, {}).setdefault(user_id, {'wins': 0, 'profit': 0})
+                entry['wins'] += 1 if won else 0
+                entry['profit'] += win_amount - bet_amount
+                for metric in METRICS:
+                    self._update(key, metric, user_id, entry[metric])
+
+    def top(self, game_type=OVERALL, metric="profit", limit=None):
+        """Best players as [(user_id, value), ...]"""
+        with self._lock:
+            top = self._top.get((game_type, metric), [])
+            return [(user_id, value) for value, user_id in top[:limit or self.size]]
+
+    def _update(self, game_type, metric, user_id, value):
+        top = self._top.setdefault((game_type, metric), [])
+        position = next((i for i, (_, uid) in enumerate(top) if uid == user_id), None)
+
+        if position is None:
+            # Игрок вне топа: попадает туда, только если обошёл последнего
+            if len(top) < self.size or _rank((value, user_id)) < _rank(top[-1]):
+                top.append((value, user_id))
+                top.sort(key=_rank)
+                del top[self.size:]
+            return
+
+        threshold = _rank(top[-1])
+        top[position] = (value, user_id)
+        if len(top) == self.size and _rank((value, user_id)) > threshold:
+            # Игрок из топа опустился ниже порога - его мог обойти кто-то снаружи
+            self._rebuild(game_type, metric)
+        else:
+            top.sort(key=_rank)
+
+    def _rebuild(self, game_type, metric):
+        candidates = [(entry[metric], user_id)
+                      for user_id, entry in self._totals.get(game_type, {}).items()]
+        candidates.sort(key=_rank)
+        self._top[(game_type, metric)] = candidates[:self.size]
+        self.rebuilds += 1
+
+
+def _rank(item):
+    """Sort key: bigger value first, then smaller user_id"""
+    value, user_id = item
+    return -value, user_id
@@ -1,9 +1,12 @@
 import logging
 from telegram import Update, LabeledPrice, InlineKeyboardButton, InlineKeyboardMarkup 
-from telegram.ext import ( Application, CommandHandler, CallbackQueryHandler, PreCheckoutQueryHandler, MessageHandler, filters, ContextTypes )
+from telegram.ext import ( Application, CommandHandler, CallbackQueryHandler, PreCheckoutQueryHandler, MessageHandler, TypeHandler, ApplicationHandlerStop, filters, ContextTypes )
 
 from config import *
-from database import Database
+from telegram.error import TelegramError
+from database import (Database, AsyncDatabase, MAX_BALANCE, PAYMENT_APPLIED, PAYMENT_DUPLICATE, PAYMENT_REJECTED,
+                      PAYMENT_UNKNOWN_USER, PAYMENT_FAILED)
+from wallet import WalletEngine
 from utils import * 
 from games.roulette import Roulette 
 from games.blackjack import Blackjack
@@ -14,7 +17,43 @@ import asyncio
 logging.basicConfig( format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO ) 
 logger = logging.getLogger()
 
-db = Database(DATABASE_NAME)
+# Повторы зачисления платежа при ошибке базы, прежде чем вернуть оплату
+PAYMENT_RETRIES = 2
+PAYMENT_RETRY_DELAY = 1
+
+# Почему платёж не зачислен: (для лога, для игрока)
+PAYMENT_FAILURES = {
+    PAYMENT_REJECTED: ("balance limit exceeded", "баланс превысил бы максимум"),
+    PAYMENT_UNKNOWN_USER: ("unknown user", "игрок не найден, начните с /start"),
+    PAYMENT_FAILED: ("database error", "временная ошибка"),
+}
+
+# Запросы к SQLite выполняются в отдельных потоках и не блокируют event loop
+db = AsyncDatabase(
+    Database(DATABASE_NAME, pool_size=DB_POOL_SIZE, pool_max_lifetime=DB_POOL_MAX_LIFETIME,
+             profile=DB_PROFILE, ledger_batch_size=LEDGER_BATCH_SIZE,
+             ledger_flush_interval=LEDGER_FLUSH_INTERVAL_MS / 1000, ledger_max_pending=LEDGER_MAX_PENDING,
+             balance_cache_size=BALANCE_CACHE_SIZE, balance_cache_enabled=BALANCE_CACHE_ENABLED,
+             balance_cache_ttl=BALANCE_CACHE_TTL,
+             ban_refresh_interval=BAN_REFRESH_INTERVAL, leaderboard_size=LEADERBOARD_SIZE,
+             archive_dir=ARCHIVE_DIR, archive_after_days=ARCHIVE_AFTER_DAYS,
+             archive_interval=ARCHIVE_INTERVAL, lock_stripes=BALANCE_LOCK_STRIPES,
+             write_retries=DB_WRITE_RETRIES, write_backoff=DB_WRITE_BACKOFF_MS / 1000,
+             backup_dir=BACKUP_DIR, backup_interval=BACKUP_INTERVAL, backup_keep_last=BACKUP_KEEP_LAST,
+             backup_keep_days=BACKUP_KEEP_DAYS, backup_step_pages=BACKUP_STEP_PAGES,
+             backup_step_sleep=BACKUP_STEP_SLEEP_MS / 1000, reconcile_interval=RECONCILE_INTERVAL,
+             reconcile_chunk_size=RECONCILE_CHUNK_SIZE, reconcile_duty_cycle=RECONCILE_DUTY_CYCLE,
+             reconcile_settle=RECONCILE_SETTLE,
+             wallet=WalletEngine(WALLET_DIR, max_balance=MAX_BALANCE,
+                                 fsync_interval=WALLET_FSYNC_INTERVAL_MS / 1000,
+                                 snapshot_interval=WALLET_SNAPSHOT_INTERVAL,
+                                 snapshot_records=WALLET_SNAPSHOT_RECORDS) if WALLET_ENABLED else None,
+             wallet_sync_interval=WALLET_SYNC_INTERVAL, activity_flush_interval=ACTIVITY_FLUSH_INTERVAL,
+             stats_batch_size=GAME_STATS_BATCH_SIZE, stats_flush_interval=GAME_STATS_FLUSH_INTERVAL_MS / 1000,
+             backfill_chunk_size=SCHEMA_BACKFILL_CHUNK, backfill_pause=SCHEMA_BACKFILL_PAUSE_MS / 1000),
+    workers=DB_WORKERS, read_workers=DB_READ_WORKERS, max_pending=DB_MAX_PENDING)
+logger.info(f"Database pragmas: {db.database.get_pragma_report()}")
+logger.info(f"Database schema: {db.database.get_schema_stats()}")
 
 roulette = Roulette()
 blackjack = Blackjack()
@@ -23,15 +62,22 @@ chess = Chess()
 
 active_games = {}
 
+async def ban_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Не пропускаем обновления от забаненных пользователей дальше"""
+    user = update.effective_user
+    # Проверка идёт по множеству в памяти, поэтому без executor'а
+    if user and db.database.is_user_banned(user.id):
+        raise ApplicationHandlerStop
+
 #============ КОМАНДЫ БОТА =============
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start""" 
     user = update.effective_user
 
         # Добавляем пользователя в БД если его нет
-    db.add_user(user.id, user.username or user.first_name, START_BALANCE)
+    await db.add_user(user.id, user.username or user.first_name, START_BALANCE)
 
-    balance = db.get_balance(user.id)
+    balance = await db.get_balance(user.id)
 
     welcome_text = f"""
     🎰 Добро пожаловать в Telegram Casino!
@@ -53,7 +99,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer()
 
         user_id = query.from_user.id
-        balance = db.get_balance(user_id)
+        balance = await db.get_balance(user_id)
 
         text = f"""
         💰 Ваш баланс
@@ -77,7 +123,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer()
 
         user_id = query.from_user.id
-        stats = db.get_user_stats(user_id)
+        stats = await db.get_user_stats(user_id)
 
         text = format_stats(stats)
 
@@ -85,6 +131,42 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text,
         reply_markup=create_back_button(),
         parse_mode='HTML')
+    async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Постраничная история транзакций"""
+        query = update.callback_query
+        await query.answer()
+
+        user_id = query.from_user.id
+
+        # history - первая страница, history_<id> - транзакции старше id
+        parts = query.data.split('_')
+        before_id = int(parts[1]) if len(parts) > 1 else None
+
+        # Берём на одну строку больше, чтобы понять, есть ли следующая страница
+        rows = await db.get_transactions(user_id, before_id, HISTORY_PAGE_SIZE + 1)
+        page = rows[:HISTORY_PAGE_SIZE]
+        next_before_id = page[-1][0] if len(rows) > HISTORY_PAGE_SIZE else None
+
+        await query.edit_message_text(
+        format_history(page, first_page=before_id is None),
+        reply_markup=create_history_keyboard(next_before_id, first_page=before_id is None),
+        parse_mode='HTML')
+    async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Таблица лидеров по играм"""
+        query = update.callback_query
+        await query.answer()
+
+        # leaderboard или leaderboard_<игра>_<показатель>
+        parts = query.data.split('_')
+        game_type = parts[1] if len(parts) > 2 else "all"
+        metric = parts[2] if len(parts) > 2 else "profit"
+
+        leaders = await db.get_leaderboard(game_type, metric)
+
+        await query.edit_message_text(
+        format_leaderboard(leaders, game_type, metric),
+        reply_markup=create_leaderboard_keyboard(game_type, metric),
+        parse_mode='HTML')
  #============ ПОКУПКА ЗВЁЗД =============
     async def buy_stars_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Меню покупки звёзд"""
@@ -146,17 +228,47 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     amount = int(amount)
     user_id = int(user_id)
 
-    # Пополняем баланс
-    db.update_balance(user_id, amount)
-    db.add_transaction(user_id, "purchase", amount, "buy_stars")
-
-    new_balance = db.get_balance(user_id)
-
-    await update.message.reply_text(
-    f"✅ Оплата прошла успешно!\n\n"
-    f"Вам начислено: {amount} ⭐\n"
-    f"Новый баланс: {new_balance} ⭐",
-    reply_markup=create_main_menu())
+    # Пополняем баланс один раз на платёж: Telegram может доставить апдейт повторно
+    charge_id = payment.telegram_payment_charge_id
+    status, new_balance = await db.record_payment(charge_id, user_id, amount, payload)
+    for _ in range(PAYMENT_RETRIES):
+        if status != PAYMENT_FAILED:
+            break
+        # Ошибка базы могла быть временной - пробуем ещё раз, прежде чем возвращать оплату
+        await asyncio.sleep(PAYMENT_RETRY_DELAY)
+        status, new_balance = await db.record_payment(charge_id, user_id, amount, payload)
+    if status not in (PAYMENT_APPLIED, PAYMENT_DUPLICATE):
+        # Тот же платёж мог зачислить другой процесс бота - возвращаем деньги, только если его точно нет
+        applied = await db.is_payment_applied(charge_id)
+        if applied:
+            status = PAYMENT_DUPLICATE
+        elif applied is None:
+            logger.error(f"Payment {charge_id} ({payload}) was not credited and can't be checked, no refund")
+            await update.message.reply_text(
+            "⏳ Оплата получена, но звёзды пока не зачислены.\n"
+            "Обратитесь в поддержку, мы проверим платёж.",
+            reply_markup=create_main_menu())
+            return
+    if status == PAYMENT_DUPLICATE:
+        logger.info(f"Payment {charge_id} already applied, update redelivered")
+    elif status == PAYMENT_APPLIED:
+        await update.message.reply_text(
+        f"✅ Оплата прошла успешно!\n\n"
+        f"Вам начислено: {amount} ⭐\n"
+        f"Новый баланс: {new_balance} ⭐",
+        reply_markup=create_main_menu())
+    else:
+        # Звёзды не зачислены - возвращаем оплату, чтобы игрок не остался без денег и без звёзд
+        log_reason, reason = PAYMENT_FAILURES[status]
+        logger.error(f"Payment {charge_id} ({payload}) was not credited: {log_reason}")
+        try:
+            await context.bot.refund_star_payment(update.message.from_user.id, charge_id)
+            text = f"❌ Не удалось зачислить звёзды: {reason}.\nОплата возвращена."
+        except TelegramError as e:
+            logger.error(f"Refund of payment {charge_id} failed: {e}")
+            text = (f"❌ Не удалось зачислить звёзды: {reason}.\n"
+                    f"Оплату вернём вручную, обратитесь в поддержку.")
+        await update.message.reply_text(text, reply_markup=create_main_menu())
     #============ РУЛЕТКА =============
     async def start_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начало игры в рулетку"""
@@ -202,32 +314,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id = query.from_user.id
     bet_amount = int(query.data.split('_')[-1])
     
-            # Проверяем баланс
-    balance = db.get_balance(user_id)
-    if balance < bet_amount:
-        await query.answer("❌ Недостаточно средств!", show_alert=True)
-    return
-    
             # Получаем тип ставки с проверкой
     user_game_data = active_games.get(user_id, {})
     bet_type = user_game_data.get('roulette_bet_type', 'red')  # Значение по умолчанию 'red'
     
-            # Снимаем ставку
-    db.update_balance(user_id, -bet_amount)
-    db.add_transaction(user_id, "roulette", bet_amount, "bet")
-    
             # Крутим рулетку
     result, win, message = roulette.spin(bet_type, bet_amount)
     
-            # Начисляем выигрыш если есть
-    if win > 0:
-                db.update_balance(user_id, win)
-                db.add_transaction(user_id, "roulette", win, "win")
-                db.update_game_stats(user_id, "roulette", True, bet_amount, win)
-    else:
-                db.update_game_stats(user_id, "roulette", False, bet_amount, 0)
-    
-    new_balance = db.get_balance(user_id)
+            # Списываем ставку и начисляем выигрыш одной транзакцией
+    new_balance = await db.settle_round(user_id, "roulette", bet_amount, win, win > 0)
+    if new_balance is None:
+        await query.answer("❌ Недостаточно средств!", show_alert=True)
+        return
     
     full_message = f"{message}\n\n{format_balance(new_balance)}"
     
@@ -261,15 +359,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = query.from_user.id
         bet_amount = int(query.data.split('_')[-1])
 
-        # Проверяем баланс
-        balance = db.get_balance(user_id)
-        if balance < bet_amount:
+        # Снимаем ставку (баланс и запись в журнал одной транзакцией)
+        if await db.place_bet(user_id, "blackjack", bet_amount) is None:
             await query.answer("❌ Недостаточно средств!", show_alert=True)
-        return
-
-        # Снимаем ставку
-        db.update_balance(user_id, -bet_amount)
-        db.add_transaction(user_id, "blackjack", bet_amount, "bet")
+            return
 
         # Создаём колоду и раздаём карты
     deck = blackjack.create_deck()
@@ -363,15 +456,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     multiplier, result_message = blackjack.check_winner(player_value, dealer_value)
     win = int(game['bet'] * multiplier)
 
-    # Начисляем выигрыш
-    if win > 0:
-        db.update_balance(user_id, win)
-        db.add_transaction(user_id, "blackjack", win, "win")
-        db.update_game_stats(user_id, "blackjack", multiplier >= 2, game['bet'], win)
-    else:
-        db.update_game_stats(user_id, "blackjack", False, game['bet'], 0)
-
-    new_balance = db.get_balance(user_id)
+    # Начисляем выигрыш (ставка уже списана в blackjack_place_bet)
+    new_balance = await db.settle_round(user_id, "blackjack", game['bet'], win, multiplier >= 2, bet_placed=True)
+    if new_balance is None:
+        logger.error(f"Blackjack round of {user_id} was not settled: bet {game['bet']}, win {win}")
 
     text = f"🂡 <b>Блекджек - Результат</b>\n\n"
     text += f"Ваши карты: {blackjack.format_hand(game['player_hand'])}\n"
@@ -379,8 +467,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += f"Карты дилера: {blackjack.format_hand(dealer_hand)}\n"
     text += f"Очки дилера: {dealer_value}\n\n"
     text += f"{result_message}\n\n"
-    if win > 0:
+    if new_balance is None:
+        text += "⚠️ Не удалось записать результат игры, обратитесь в поддержку"
+    elif win > 0:
         text += f"Выигрыш: {win} ⭐\n"
+        if new_balance == MAX_BALANCE:
+            text += "Баланс достиг максимума, выигрыш начислен до лимита\n"
         text += f"{format_balance(new_balance)}"
 
     keyboard = [
@@ -426,15 +518,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     bet_amount = int(query.data.split('_')[-1])
 
- # Проверяем баланс
-    balance = db.get_balance(user_id)
-    if balance < bet_amount:
+ # Снимаем ставку (баланс и запись в журнал одной транзакцией)
+    if await db.place_bet(user_id, "poker", bet_amount) is None:
         await query.answer("❌ Недостаточно средств!", show_alert=True)
-    return
-
- # Снимаем ставку
-    db.update_balance(user_id, -bet_amount)
-    db.add_transaction(user_id, "poker", bet_amount, "bet")
+        return
 
  # Создаём колоду и раздаём карты
     deck = poker.create_deck()
@@ -573,15 +660,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         result = "😢 Бот победил!"
         won = False
 
-    # Начисляем выигрыш
-    if win > 0:
-        db.update_balance(user_id, win)
-        db.add_transaction(user_id, "poker", win, "win")
-        db.update_game_stats(user_id, "poker", won, game['bet'], win)
-    else:
-        db.update_game_stats(user_id, "poker", False, game['bet'], 0)
-
-    new_balance = db.get_balance(user_id)
+    # Начисляем выигрыш (ставка уже списана в poker_place_bet)
+    new_balance = await db.settle_round(user_id, "poker", game['bet'], win, won, bet_placed=True)
+    if new_balance is None:
+        logger.error(f"Poker round of {user_id} was not settled: bet {game['bet']}, win {win}")
 
     text = f"🃏 <b>Техасский Холдем - Результат</b>\n\n"
     text += f"Ваши карты: {poker.format_cards(game['player_hand'])}\n"
@@ -590,8 +672,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += f"Комбинация бота: {bot_combo}\n\n"
     text += f"Общие карты: {poker.format_cards(game['community'])}\n\n"
     text += f"{result}\n\n"
-    if win > 0:
+    if new_balance is None:
+        text += "⚠️ Не удалось записать результат игры, обратитесь в поддержку"
+    elif win > 0:
         text += f"Выигрыш: {win} ⭐\n"
+        if new_balance == MAX_BALANCE:
+            text += "Баланс достиг максимума, выигрыш начислен до лимита\n"
         text += f"{format_balance(new_balance)}"
 
     keyboard = [
@@ -615,7 +701,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if user_id in active_games and active_games[user_id].get('game') == 'poker':
         bet_amount = active_games[user_id]['bet']
-        db.update_game_stats(user_id, "poker", False, bet_amount, 0)
+        await db.settle_round(user_id, "poker", bet_amount, 0, False, bet_placed=True)
         del active_games[user_id]
 
     text = "Вы сдались и потеряли ставку. 😢"
@@ -854,7 +940,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer()
     
         user_id = query.from_user.id
-        balance = db.get_balance(user_id)
+        balance = await db.get_balance(user_id)
     
     text = f"""
     🎰 Telegram Casino
@@ -894,12 +980,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Создаём приложение
         application = Application.builder().token(BOT_TOKEN).build()
     
+        # Проверка бана перед всеми остальными обработчиками
+        application.add_handler(TypeHandler(Update, ban_gate), group=-1)
+
         # Регистрируем обработчики команд
         application.add_handler(CommandHandler("start", start))
     
     # Регистрируем обработчики кнопок
         application.add_handler(CallbackQueryHandler(check_balance, pattern="^check_balance$"))
         application.add_handler(CallbackQueryHandler(show_stats, pattern="^show_stats$"))
+        application.add_handler(CallbackQueryHandler(show_history, pattern="^history(_\\d+)?$"))
+        application.add_handler(CallbackQueryHandler(show_leaderboard, pattern="^leaderboard(_[a-z]+_(profit|wins))?$"))
         application.add_handler(CallbackQueryHandler(buy_stars_menu, pattern="^buy_stars$"))
         application.add_handler(CallbackQueryHandler(process_purchase, pattern="^purchase_"))
         application.add_handler(CallbackQueryHandler(start_roulette, pattern="^game_roulette$"))
@@ -932,5 +1023,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Запускаем бота
         application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+        # Закрываем соединения с базой
+        logger.info(f"DB pool stats: {db.database.get_pool_stats()}")
+        logger.info(f"DB queue stats: {db.get_queue_stats()}")
+        logger.info(f"Ledger writer stats: {db.database.get_ledger_stats()}")
+        logger.info(f"Balance cache stats: {db.database.get_cache_stats()}")
+        logger.info(f"Balance lock stats: {db.database.get_lock_stats()}")
+        logger.info(f"DB write stats: {db.database.get_write_stats()}")
+        logger.info(f"Backup stats: {db.database.get_backup_stats()}")
+        logger.info(f"Reconcile stats: {db.database.get_reconcile_stats()}")
+        logger.info(f"Wallet stats: {db.database.get_wallet_stats()}")
+        logger.info(f"Activity stats: {db.database.get_activity_stats()}")
+        logger.info(f"Game stats buffer: {db.database.get_stats_buffer_stats()}")
+        logger.info(f"Schema stats: {db.database.get_schema_stats()}")
+        db.close()
+
     if __name__ == "__main__":
         main()
@@ -0,0 +1,192 @@
+import argparse
+import os
+import time
+from datetime import datetime
+
+from config import (DATABASE_NAME, DB_PROFILE, ARCHIVE_DIR, ARCHIVE_AFTER_DAYS, BACKUP_DIR,
+                    BACKUP_KEEP_LAST, BACKUP_KEEP_DAYS, BACKUP_STEP_PAGES, BACKUP_STEP_SLEEP_MS,
+                    RECONCILE_SETTLE, SCHEMA_BACKFILL_CHUNK, SCHEMA_BACKFILL_PAUSE_MS)
+from database import Database
+from export import WRITERS, export_ledger
+
+
+def backfill_rollups(db, args):
+    """Пересчёт сводных таблиц по всему журналу транзакций"""
+    started = time.perf_counter()
+
+    def progress(done_id, last_id):
+        print(f"  {done_id}/{last_id} транзакций")
+
+    last_id = db.backfill_rollups(chunk_size=args.chunk_size, progress=progress)
+    print(f"✅ Сводные таблицы пересчитаны ({last_id} транзакций, {time.perf_counter() - started:.1f} с)")
+
+
+def list_partitions(db, args):
+    """Список месячных партиций журнала"""
+    for month, name, state, location in db.list_partitions():
+        print(f"{month}  {name:<22} {state:<9} {location or ''}")
+
+
+def detach_partitions(db, args):
+    """Отсоединение партиций старше keep_months месяцев в отдельные файлы"""
+    now = datetime.now()
+    month_index = now.year * 12 + now.month - 1 - args.keep_months
+    oldest_kept = f"{month_index // 12:04d}{month_index % 12 + 1:02d}"
+    os.makedirs(args.dir, exist_ok=True)
+
+    for month, _, state, _ in db.list_partitions():
+        if state != "active" or month >= oldest_kept:
+            continue
+        path = db.detach_partition(month, args.dir)
+        if path:
+            print(f"✅ {month} -> {path}")
+        else:
+            print(f"❌ {month} не удалось отсоединить")
+
+
+def archive_ledger(db, args):
+    """Перенос старых месяцев журнала в сжатый архив"""
+    started = time.perf_counter()
+
+    def progress(month, total):
+        print(f"  {month}: {total} строк в архиве")
+
+    total = db.archive_ledger(args.older_than_days, chunk_size=args.chunk_size, progress=progress)
+    print(f"✅ В архив перенесено {total} строк ({time.perf_counter() - started:.1f} с)")
+
+
+def backup(db, args):
+    """Снимок базы на лету с проверкой целостности и удалением старых снимков"""
+    report = db.backup()
+    if report is None:
+        print("❌ Резервная копия не создана")
+        raise SystemExit(1)
+    print(f"✅ {report['path']}: {report['pages']} страниц, {report['bytes'] / 1048576:.1f} МБ "
+          f"за {report['seconds']:.1f} с ({report['mb_per_sec']:.1f} МБ/с, шагов {report['steps']}, "
+          f"перезапусков {report['restarts']}, проверка {report['verify_seconds']:.1f} с)")
+    for path in report['pruned']:
+        print(f"  удалён старый снимок {path}")
+
+
+def list_backups(db, args):
+    """Список снимков базы"""
+    for path in db.backups.snapshots():
+        print(f"{path}  {os.path.getsize(path) / 1048576:.1f} МБ")
+
+
+def export(db, args):
+    """Выгрузка журнала транзакций потоком, без загрузки всей таблицы в память"""
+    since = datetime.strptime(args.since, "%Y-%m-%d") if args.since else None
+    until = datetime.strptime(args.until, "%Y-%m-%d") if args.until else None
+
+    def report(rows, rows_per_sec):
+        print(f"  {rows} строк ({rows_per_sec:.0f} строк/с)")
+
+    rows, seconds, rows_per_sec = export_ledger(db, args.output, args.format, since=since, until=until,
+                                                user_id=args.user, game_type=args.game,
+                                                batch_size=args.batch_size, report=report)
+    print(f"✅ {args.output}: {rows} строк за {seconds:.1f} с ({rows_per_sec:.0f} строк/с)")
+
+
+def reconcile(db, args):
+    """Сверка балансов с журналом транзакций (только строки после прошлой сверки)"""
+    def progress(last_id, rows):
+        print(f"  до транзакции {last_id}: {rows} строк")
+
+    report = db.reconcile(chunk_size=args.chunk_size, duty_cycle=args.duty_cycle, progress=progress)
+    if report is None:
+        print("❌ Сверка не выполнена")
+        raise SystemExit(1)
+    print(f"✅ Проверено {report['rows']} строк журнала и {report['checked']} счетов "
+          f"(новых точек отсчёта {report['baselined']}) за {report['seconds']:.1f} с")
+    drifting = db.get_drifting_accounts()
+    for user_id, balance, expected, drift in drifting:
+        print(f"  ⚠️ {user_id}: баланс {balance}, по журналу {expected} (расхождение {drift:+d})")
+    if drifting:
+        raise SystemExit(2)
+
+
+def migrate(db, args):
+    """Версия схемы и незаконченные переносы данных (миграции применяются при открытии базы)"""
+    stats = db.get_schema_stats()
+    for name in stats['applied']:
+        print(f"  применена миграция {name}")
+    print(f"✅ Схема версии {stats['version']} из {stats['latest']}")
+    for name, (done_id, target_id) in stats['backfills'].items():
+        print(f"  ⏳ {name}: {done_id}/{target_id} транзакций")
+    if not args.backfill or not stats['backfills']:
+        return
+
+    def progress(name, done_id, target_id):
+        print(f"  {name}: {done_id}/{target_id} транзакций")
+
+    if not db.run_backfills(chunk_size=args.chunk_size, pause=args.pause_ms / 1000, progress=progress):
+        print("❌ Переносы данных не закончены")
+        raise SystemExit(1)
+    print("✅ Переносы данных закончены")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание базы данных казино")
+    parser.add_argument("--db", default=DATABASE_NAME, help="файл базы данных")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    backfill = commands.add_parser("backfill-rollups", help="пересчитать сводные таблицы по журналу")
+    backfill.add_argument("--chunk-size", type=int, default=10000)
+    backfill.set_defaults(handler=backfill_rollups)
+
+    partitions = commands.add_parser("partitions", help="показать партиции журнала транзакций")
+    partitions.set_defaults(handler=list_partitions)
+
+    detach = commands.add_parser("detach-partitions", help="вынести старые партиции журнала в отдельные файлы")
+    detach.add_argument("--keep-months", type=int, default=6, help="сколько последних месяцев оставить в базе")
+    detach.add_argument("--dir", default="ledger_partitions", help="куда складывать файлы партиций")
+    detach.set_defaults(handler=detach_partitions)
+
+    archive = commands.add_parser("archive-ledger", help="перенести старые месяцы журнала в сжатый архив")
+    archive.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    archive.add_argument("--chunk-size", type=int, default=5000)
+    archive.set_defaults(handler=archive_ledger)
+
+    snapshot = commands.add_parser("backup", help="сделать резервную копию базы, не останавливая бота")
+    snapshot.set_defaults(handler=backup)
+
+    backups = commands.add_parser("backups", help="показать резервные копии")
+    backups.set_defaults(handler=list_backups)
+
+    ledger = commands.add_parser("export-ledger", help="выгрузить журнал транзакций в CSV или колоночный файл")
+    ledger.add_argument("output", help="файл, куда писать")
+    ledger.add_argument("--format", choices=sorted(WRITERS), default="csv")
+    ledger.add_argument("--since", help="с даты YYYY-MM-DD включительно")
+    ledger.add_argument("--until", help="по дату YYYY-MM-DD не включительно")
+    ledger.add_argument("--game", help="только эта игра (roulette, blackjack, ...)")
+    ledger.add_argument("--user", type=int, help="только этот игрок")
+    ledger.add_argument("--batch-size", type=int, default=1000)
+    ledger.set_defaults(handler=export)
+
+    check = commands.add_parser("reconcile", help="сверить балансы с журналом транзакций")
+    check.add_argument("--chunk-size", type=int, default=5000)
+    check.add_argument("--duty-cycle", type=float, default=1.0, help="доля времени работы (1 - без пауз)")
+    check.set_defaults(handler=reconcile)
+
+    schema = commands.add_parser("migrate", help="обновить схему базы и показать незаконченные переносы данных")
+    schema.add_argument("--backfill", action="store_true", help="доделать переносы данных сейчас")
+    schema.add_argument("--chunk-size", type=int, default=SCHEMA_BACKFILL_CHUNK)
+    schema.add_argument("--pause-ms", type=int, default=SCHEMA_BACKFILL_PAUSE_MS)
+    schema.set_defaults(handler=migrate)
+
+    args = parser.parse_args()
+
+    db = Database(args.db, profile=DB_PROFILE, ban_refresh_interval=0, partition_check_interval=0,
+                  archive_dir=ARCHIVE_DIR, backup_dir=BACKUP_DIR, backup_keep_last=BACKUP_KEEP_LAST,
+                  backup_keep_days=BACKUP_KEEP_DAYS, backup_step_pages=BACKUP_STEP_PAGES,
+                  backup_step_sleep=BACKUP_STEP_SLEEP_MS / 1000, reconcile_settle=RECONCILE_SETTLE,
+                  backfill_interval=0)
+    try:
+        args.handler(db, args)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import telegram  # noqa: F401
+except ImportError:
+    # Без python-telegram-bot берём заглушку; sys.path наследуют и процессы, запущенные через spawn
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs'))
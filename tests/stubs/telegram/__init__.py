@@ -0,0 +1,3 @@
+# Заглушка python-telegram-bot для тестов: database.py нужен только telegram.User
+class User:
+    pass
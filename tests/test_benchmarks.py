@@ -0,0 +1,18 @@
+from benchmarks import bench_replay, bench_stress
+
+
+def test_stress_balances_reconcile_with_ledger():
+    result = bench_stress(processes=2, users=5, rounds=100)
+    assert result['mismatched'] == {}
+    assert result['stale'] == {}
+    assert result['settled'] > 0
+    assert result['games_played'] == result['settled']
+    assert result['write_stats']['failed'] == 0
+
+
+def test_replay_credits_each_payment_once():
+    result = bench_replay(processes=2, payments=10, copies=5)
+    assert result['mismatched'] == {}
+    assert result['applied'] == result['payments']
+    assert result['payment_rows'] == result['payments']
+    assert result['ledger_rows'] == result['payments']
@@ -0,0 +1,306 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from database import (Database, MAX_BALANCE, PAYMENT_APPLIED, PAYMENT_DUPLICATE, PAYMENT_REJECTED,
+                      PAYMENT_UNKNOWN_USER, SCHEMA_MIGRATIONS)
+from wallet import WalletEngine
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / 'casino.db'), ban_refresh_interval=0, partition_check_interval=0)
+    yield db
+    db.close()
+
+
+def test_round_bet_above_balance_is_refused(db):
+    db.add_user(1, 'player', 10)
+    assert db.settle_round(1, 'roulette', 100, 0, False) is None
+    assert db.settle_round(1, 'roulette', 100, 300, True) is None
+    assert db.get_balance(1) == 10
+
+
+def test_win_above_max_balance_is_capped_not_voided(db):
+    db.add_user(1, 'player', MAX_BALANCE - 50)
+    assert db.place_bet(1, 'blackjack', 100) == MAX_BALANCE - 150
+    assert db.settle_round(1, 'blackjack', 100, 300, True, bet_placed=True) == MAX_BALANCE
+    assert db.get_user_stats(1) == [('blackjack', 1, 1, 100, 150)]
+
+
+def test_payment_not_credited_reports_reason(db):
+    db.add_user(1, 'payer', MAX_BALANCE - 10)
+    assert db.record_payment('charge_1', 1, 100) == (PAYMENT_REJECTED, MAX_BALANCE - 10)
+    assert db.record_payment('charge_2', 2, 100)[0] == PAYMENT_UNKNOWN_USER
+    assert db.record_payment('charge_3', 1, 10) == (PAYMENT_APPLIED, MAX_BALANCE)
+    assert db.record_payment('charge_3', 1, 10) == (PAYMENT_DUPLICATE, MAX_BALANCE)
+    # Отказ откатывает строку платежа: оплату можно вернуть
+    assert db.is_payment_applied('charge_1') is False
+    assert db.is_payment_applied('charge_3') is True
+
+
+@pytest.fixture
+def wallet_db(tmp_path):
+    wallet = WalletEngine(str(tmp_path / 'wallet'), max_balance=MAX_BALANCE)
+    db = Database(str(tmp_path / 'casino.db'), ban_refresh_interval=0, partition_check_interval=0,
+                  ledger_batch_size=100, wallet=wallet)
+    yield db
+    db.close()
+
+
+def test_wallet_bet_above_balance_is_refused(wallet_db):
+    wallet_db.add_user(7, 'player', 10)
+    assert wallet_db.place_bet(7, 'poker', 100) is None
+    assert wallet_db.place_bet(7, 'poker', 10) == 0
+
+
+def test_wallet_opens_users_added_without_it(tmp_path):
+    path = str(tmp_path / 'casino.db')
+    db = Database(path, ban_refresh_interval=0, partition_check_interval=0,
+                  wallet=WalletEngine(str(tmp_path / 'wallet'), max_balance=MAX_BALANCE))
+    db.add_user(7, 'player', 10)
+    db.close()
+    # Строка в users есть, а в журнале кошелька её нет
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO users (user_id, username, balance) VALUES (8, 'newcomer', 50)")
+    conn.commit()
+    conn.close()
+
+    db = Database(path, ban_refresh_interval=0, partition_check_interval=0,
+                  wallet=WalletEngine(str(tmp_path / 'wallet'), max_balance=MAX_BALANCE))
+    try:
+        assert db.get_balance(7) == 10
+        assert db.get_balance(8) == 50
+        assert db.place_bet(8, 'poker', 20) == 30
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def deferred_db(tmp_path):
+    wallet = WalletEngine(str(tmp_path / 'wallet'), max_balance=MAX_BALANCE)
+    db = Database(str(tmp_path / 'casino.db'), ban_refresh_interval=0, partition_check_interval=0,
+                  ledger_batch_size=100, stats_batch_size=100, wallet=wallet)
+    yield db
+    db.close()
+
+
+def test_deferred_round_rejected_without_transaction(deferred_db):
+    deferred_db.add_user(7, 'player', 10)
+    assert deferred_db.settle_round(7, 'roulette', 100, 0, False) is None
+    assert deferred_db.settle_round(8, 'roulette', 5, 0, False) is None
+    assert deferred_db.get_balance(7) == 10
+    assert deferred_db.settle_round(7, 'roulette', 10, 20, True) == 20
+    assert deferred_db.get_user_stats(7) == [('roulette', 1, 1, 10, 20)]
+
+
+@pytest.fixture
+def buffered_db(tmp_path):
+    db = Database(str(tmp_path / 'casino.db'), ban_refresh_interval=0, partition_check_interval=0,
+                  ledger_batch_size=100, ledger_flush_interval=0.01)
+    yield db
+    db.close()
+
+
+def test_history_and_rollups_do_not_wait_for_writer(buffered_db):
+    buffered_db.add_user(1, 'player', 100)
+    buffered_db.ledger.worker.stop()
+    assert buffered_db.settle_round(1, 'roulette', 10, 20, True) == 110
+    result = {}
+    with buffered_db.write_lock:
+        thread = threading.Thread(target=lambda: result.update(
+            page=buffered_db.get_transactions(1), rollups=buffered_db.get_rollups('day')))
+        thread.start()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+    assert [(row[0], row[2], row[3]) for row in result['page']] == [(None, 20, 'win'), (None, 10, 'bet')]
+    assert sorted((row[2], row[3], row[4]) for row in result['rollups']) == [('bet', 1, 10), ('win', 1, 20)]
+
+
+def test_history_counts_each_row_once_while_flushing(buffered_db):
+    buffered_db.add_user(1, 'player', 100000)
+    stop = threading.Event()
+
+    def play():
+        while not stop.is_set():
+            buffered_db.settle_round(1, 'roulette', 1, 0, False)
+
+    thread = threading.Thread(target=play)
+    thread.start()
+    try:
+        for _ in range(200):
+            before = 100000 - buffered_db.get_balance(1)
+            rows = sum(row[3] for row in buffered_db.get_rollups('day'))
+            after = 100000 - buffered_db.get_balance(1)
+            # Между коммитом баланса и попаданием строки в буфер может быть не больше одного раунда
+            assert before - 1 <= rows <= after
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_stats_count_each_round_once_while_flushing(tmp_path):
+    db = Database(str(tmp_path / 'casino.db'), ban_refresh_interval=0, partition_check_interval=0,
+                  stats_batch_size=100)
+    try:
+        db.add_user(1, 'player', 100)
+        db.stats_buffer.worker.stop()
+        assert db.settle_round(1, 'roulette', 10, 0, False) == 90
+
+        # Пачка уже закоммичена, а запись ещё не вернулась в flush
+        committed, release = threading.Event(), threading.Event()
+        write_deltas = db.stats_buffer.write_deltas
+
+        def slow_write(rows, commit):
+            write_deltas(rows, commit)
+            committed.set()
+            release.wait(5)
+
+        db.stats_buffer.write_deltas = slow_write
+        thread = threading.Thread(target=db.stats_buffer.flush)
+        thread.start()
+        try:
+            assert committed.wait(5)
+            assert db.get_user_stats(1) == [('roulette', 1, 0, 10, 0)]
+        finally:
+            release.set()
+            thread.join()
+        assert db.get_user_stats(1) == [('roulette', 1, 0, 10, 0)]
+    finally:
+        db.close()
+
+def test_cached_balance_expires_after_outside_update(tmp_path):
+    db = Database(str(tmp_path / 'casino.db'), ban_refresh_interval=0, partition_check_interval=0,
+                  balance_cache_ttl=0.05)
+    try:
+        db.add_user(1, 'player', 1000)
+        assert db.change_balance(1, 10) == 1010
+        assert db.get_balance(1) == 1010
+        # Другой процесс бота меняет строку мимо этого кэша
+        conn = sqlite3.connect(str(tmp_path / 'casino.db'))
+        conn.execute('UPDATE users SET balance = 1017, version = version + 1 WHERE user_id = 1')
+        conn.commit()
+        conn.close()
+        time.sleep(0.1)
+        assert db.get_balance(1) == 1017
+    finally:
+        db.close()
+
+
+def test_payment_ledger_row_is_written_with_payment(buffered_db):
+    buffered_db.ledger.worker.stop()
+    buffered_db.add_user(1, 'payer', 0)
+    assert buffered_db.record_payment('charge_1', 1, 50) == (PAYMENT_APPLIED, 50)
+    assert buffered_db.ledger.pending() == []
+    conn = sqlite3.connect(buffered_db.db_name)
+    assert conn.execute('SELECT user_id, amount FROM transactions').fetchall() == [(1, 50)]
+    conn.close()
+
+
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        balance INTEGER DEFAULT 0 CHECK(balance >= 0),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_banned INTEGER DEFAULT 0
+    );
+    CREATE TABLE transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        game_type TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        transaction_type TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+    CREATE TABLE game_stats (
+        user_id INTEGER NOT NULL,
+        game_type TEXT NOT NULL,
+        games_played INTEGER DEFAULT 0 CHECK(games_played >= 0),
+        games_won INTEGER DEFAULT 0 CHECK(games_won >= 0),
+        total_bet INTEGER DEFAULT 0 CHECK(total_bet >= 0),
+        total_won INTEGER DEFAULT 0 CHECK(total_won >= 0),
+        PRIMARY KEY (user_id, game_type),
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+    CREATE INDEX idx_transactions_user ON transactions(user_id);
+    CREATE INDEX idx_transactions_time ON transactions(timestamp);
+'''
+
+
+def test_upgrade_from_baseline_text_schema(tmp_path):
+    path = str(tmp_path / 'casino.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany('INSERT INTO users (user_id, username, balance, created_at, last_active) VALUES (?, ?, ?, ?, ?)',
+                     [(1, 'alice', 70, '2025-01-10 09:00:00.123456', '2025-02-01 10:00:00'),
+                      (2, 'bob', 220, '2025-01-11 09:00:00', '2025-02-01 11:00:00')])
+    conn.executemany('''
+        INSERT INTO transactions (user_id, game_type, amount, transaction_type, timestamp) VALUES (?, ?, ?, ?, ?)
+    ''', [(1, 'roulette', 30, 'bet', '2025-01-20 12:00:00'),
+          (2, 'blackjack', 50, 'bet', '2025-01-21 12:00:00'),
+          (2, 'blackjack', 100, 'win', '2025-01-21 12:00:05'),
+          (2, 'purchase', 70, 'buy_stars', '2025-02-01 11:00:00.654321')])
+    conn.executemany('INSERT INTO game_stats VALUES (?, ?, ?, ?, ?, ?)',
+                     [(1, 'roulette', 1, 0, 30, 0), (2, 'blackjack', 1, 1, 50, 100)])
+    conn.commit()
+    conn.close()
+
+    db = Database(path, ban_refresh_interval=0, partition_check_interval=0, backfill_interval=0)
+    try:
+        schema = db.get_schema_stats()
+        assert schema['version'] == schema['latest'] == len(SCHEMA_MIGRATIONS)
+        assert schema['backfills'] == {'rollups': (0, 4)}
+
+        assert db.get_balance(1) == 70
+        assert db.get_balance(2) == 220
+        assert db.get_user_stats(1) == [('roulette', 1, 0, 30, 0)]
+        assert db.get_user_stats(2) == [('blackjack', 1, 1, 50, 100)]
+        assert db.get_transactions(2) == [
+            (4, 'purchase', 70, 'buy_stars', '2025-02-01 11:00:00'),
+            (3, 'blackjack', 100, 'win', '2025-01-21 12:00:05'),
+            (2, 'blackjack', 50, 'bet', '2025-01-21 12:00:00'),
+        ]
+
+        assert db.run_backfills(chunk_size=2, pause=0)
+        assert db.get_schema_stats()['backfills'] == {}
+        assert db.get_rollups('day') == [
+            ('2025-01-20', 'roulette', 'bet', 1, 30),
+            ('2025-01-21', 'blackjack', 'bet', 1, 50),
+            ('2025-01-21', 'blackjack', 'win', 1, 100),
+            ('2025-02-01', 'purchase', 'buy_stars', 1, 70),
+        ]
+        # Новые строки журнала продолжают сквозную нумерацию
+        assert db.settle_round(1, 'roulette', 10, 0, False) == 60
+        assert db.get_transactions(1)[0][0] == 5
+    finally:
+        db.close()
+    conn = sqlite3.connect(path)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(SCHEMA_MIGRATIONS)
+    conn.close()
+
+
+def test_history_survives_partition_archived_by_other_process(tmp_path):
+    path, archive = str(tmp_path / 'casino.db'), str(tmp_path / 'archive')
+    first = Database(path, ban_refresh_interval=0, partition_check_interval=0, archive_dir=archive)
+    first.add_user(1, 'player', 100)
+    first._write_ledger_rows([(1, 'roulette', 10, 'bet', datetime(2025, 1, 5, 12, 0))])
+    assert first.settle_round(1, 'roulette', 5, 0, False) == 95
+    second = Database(path, ban_refresh_interval=0, partition_check_interval=0, archive_dir=archive)
+    try:
+        # Январскую партицию убирает первый процесс, а второй всё ещё держит её в каталоге
+        assert first.archive_ledger(older_than_days=90) == 1
+        assert '202501' in second.partitions
+
+        page = second.get_transactions(1)
+        assert [(row[2], row[3]) for row in page] == [(5, 'bet'), (10, 'bet')]
+        assert [row[3] for row in second.iter_ledger(user_id=1)] == [10, 5]
+        assert '202501' not in second.partitions
+    finally:
+        second.close()
+        first.close()
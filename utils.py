@@ -1,6 +1,25 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import html
 
+GAME_NAMES = {
+    "poker": "🃏 Покер",
+    "roulette": "🎰 Рулетка",
+    "blackjack": "🂡 Блекджек",
+    "chess": "♟️ Шахматы",
+    "purchase": "⭐ Пополнение"
+}
+
+LEADERBOARD_METRICS = {
+    "profit": "💰 Прибыль",
+    "wins": "🏅 Победы"
+}
+
+TRANSACTION_NAMES = {
+    "bet": "Ставка",
+    "win": "Выигрыш",
+    "buy_stars": "Покупка звёзд"
+}
+
 def sanitize_text(text):
     """Защита от XSS в HTML режиме"""
     return html.escape(str(text))
@@ -21,6 +40,10 @@ def create_main_menu():
             InlineKeyboardButton("💰 Баланс", callback_data="check_balance"),
             InlineKeyboardButton("📊 Статистика", callback_data="stats")
         ],
+        [
+            InlineKeyboardButton("📜 История", callback_data="history"),
+            InlineKeyboardButton("🏆 Лидеры", callback_data="leaderboard")
+        ],
         [
             InlineKeyboardButton("⭐ Купить звёзды", callback_data="buy_stars")
         ]
@@ -73,19 +96,12 @@ def format_stats(stats):
     
     text = "📊 <b>Ваша статистика:</b>\n\n"
     
-    game_names = {
-        "poker": "🃏 Покер",
-        "roulette": "🎰 Рулетка",
-        "blackjack": "🂡 Блекджек",
-        "chess": "♟️ Шахматы"
-    }
-    
     for stat in stats:
         game_type, played, won, total_bet, total_won = stat
         win_rate = (won / played * 100) if played > 0 else 0
         profit = total_won - total_bet
         
-        game_name = sanitize_text(game_names.get(game_type, game_type))
+        game_name = sanitize_text(GAME_NAMES.get(game_type, game_type))
         
         text += f"{game_name}:\n"
         text += f"  Игр сыграно: {played}\n"
@@ -97,6 +113,95 @@ def format_stats(stats):
     return text
 
 
+def format_history(transactions, first_page=True):
+    """Форматирование страницы истории транзакций"""
+    if not transactions:
+        if first_page:
+            return "📜 У вас пока нет транзакций"
+        return "📜 Больше транзакций нет"
+    
+    text = "📜 <b>История транзакций:</b>\n\n"
+    
+    for _, game_type, amount, transaction_type, timestamp in transactions:
+        sign = "-" if transaction_type == "bet" else "+"
+        game_name = sanitize_text(GAME_NAMES.get(game_type, game_type))
+        operation = sanitize_text(TRANSACTION_NAMES.get(transaction_type, transaction_type))
+        
+        text += f"{str(timestamp)[:16]} {game_name}\n"
+        text += f"  {operation}: {sign}{amount:,} ⭐\n".replace(',', ' ')
+    
+    return text
+
+
+def create_history_keyboard(next_before_id=None, first_page=True):
+    """Клавиатура для листания истории"""
+    keyboard = []
+    row = []
+    
+    if not first_page:
+        row.append(InlineKeyboardButton("⏮ В начало", callback_data="history"))
+    if next_before_id is not None:
+        row.append(InlineKeyboardButton("➡️ Дальше", callback_data=f"history_{next_before_id}"))
+    if row:
+        keyboard.append(row)
+    
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")])
+    
+    return InlineKeyboardMarkup(keyboard)
+
+
+def format_leaderboard(leaders, game_type, metric):
+    """Форматирование таблицы лидеров"""
+    game_name = GAME_NAMES.get(game_type, "🎮 Все игры")
+    metric_name = LEADERBOARD_METRICS.get(metric, metric)
+    
+    text = f"🏆 <b>Лидеры</b> - {sanitize_text(game_name)}, {sanitize_text(metric_name)}\n\n"
+    
+    if not leaders:
+        return text + "Пока никто не играл"
+    
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    
+    for place, (user_id, username, value) in enumerate(leaders, start=1):
+        name = sanitize_text(username or f"Игрок {user_id}")
+        if metric == "profit":
+            value_text = f"{value:+,} ⭐".replace(',', ' ')
+        else:
+            value_text = f"{value:,}".replace(',', ' ')
+        text += f"{medals.get(place, f'{place}.')} {name}: {value_text}\n"
+    
+    return text
+
+
+def create_leaderboard_keyboard(game_type, metric):
+    """Клавиатура выбора игры и показателя для таблицы лидеров"""
+    games = [("all", "🎮 Все")] + [(game, name) for game, name in GAME_NAMES.items()
+                                   if game not in ("chess", "purchase")]
+    
+    keyboard = []
+    row = []
+    
+    for game, name in games:
+        mark = "• " if game == game_type else ""
+        row.append(InlineKeyboardButton(f"{mark}{name}", callback_data=f"leaderboard_{game}_{metric}"))
+        
+        if len(row) == 2:
+            keyboard.append(row)
+            row = []
+    
+    if row:
+        keyboard.append(row)
+    
+    keyboard.append([
+        InlineKeyboardButton(f"{'• ' if key == metric else ''}{name}",
+                             callback_data=f"leaderboard_{game_type}_{key}")
+        for key, name in LEADERBOARD_METRICS.items()
+    ])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")])
+    
+    return InlineKeyboardMarkup(keyboard)
+
+
 def validate_bet(bet_amount, game_type, balance):
     """
     Валидация ставки
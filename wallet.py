@@ -0,0 +1,292 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+# Запись журнала: seq, user_id, изменение, баланс после изменения, crc32 первых четырёх полей
+RECORD = struct.Struct('<Qqqq')
+RECORD_CRC = struct.Struct('<I')
+RECORD_SIZE = RECORD.size + RECORD_CRC.size
+
+# Снимок: заголовок (magic, seq, число игроков), массив user_id, массив балансов, crc32 всего файла
+SNAPSHOT_MAGIC = b'WALSNAP1'
+SNAPSHOT_HEADER = struct.Struct('<8sQQ')
+
+
+class WalletEngine:
+    """Balances kept in memory as the authoritative state
+
+    Every change is appended to journal-<first seq>.log before apply() returns; the journal is
+    fsynced every fsync_interval seconds (0 - on every change). Every snapshot_interval seconds
+    or snapshot_records changes the whole state is written to snapshot-<seq>.snap and older
+    journal segments are removed. On start the state is rebuilt from the newest valid snapshot
+    plus the journal tail; a torn record at the end of the journal is cut off"""
+
+    def __init__(self, directory='wallet', max_balance=None, fsync_interval=0.05, snapshot_interval=300,
+                 snapshot_records=1000000):
+        self.directory = directory
+        self.max_balance = max_balance
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_records = snapshot_records
+        self.balances = {}
+        # Игроки, чей баланс ещё не перенесён в базу
+        self.dirty = set()
+        self.seq = 0
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._journal = None
+        self._unsynced = False
+        self._snapshot_seq = 0
+        self._snapshot_at = time.monotonic()
+        self._stats = {'records': 0, 'fsyncs': 0, 'snapshots': 0, 'recovered_records': 0,
+                       'recovered_from': None, 'truncated_bytes': 0, 'recovery_seconds': 0.0,
+                       'last_snapshot': None}
+
+        os.makedirs(directory, exist_ok=True)
+        started = time.perf_counter()
+        self._recover()
+        self._stats['recovery_seconds'] = time.perf_counter() - started
+        self._open_segment(self.seq + 1)
+
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='wallet-journal', daemon=True)
+        self._thread.start()
+
+    def _segments(self):
+        """Journal segments [(first seq, path), ...], oldest first"""
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith('journal-') and name.endswith('.log'):
+                segments.append((int(name[len('journal-'):-len('.log')]), os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def _snapshots(self):
+        """Snapshots [(seq, path), ...], newest first"""
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if name.startswith('snapshot-') and name.endswith('.snap'):
+                snapshots.append((int(name[len('snapshot-'):-len('.snap')]), os.path.join(self.directory, name)))
+        return sorted(snapshots, reverse=True)
+
+    def _recover(self):
+        for seq, path in self._snapshots():
+            try:
+                self.balances = _read_snapshot(path)
+            except (OSError, ValueError) as e:
+                # Недописанный или испорченный снимок - берём предыдущий
+                print(f"Wallet snapshot {path} skipped: {e}")
+                continue
+            self.seq = self._snapshot_seq = seq
+            self._stats['recovered_from'] = path
+            break
+
+        for _, path in self._segments():
+            with open(path, 'r+b') as f:
+                data = f.read()
+                offset = 0
+                while offset + RECORD_SIZE <= len(data):
+                    record = data[offset:offset + RECORD.size]
+                    (crc,) = RECORD_CRC.unpack_from(data, offset + RECORD.size)
+                    if zlib.crc32(record) != crc:
+                        break
+                    seq, user_id, _, balance = RECORD.unpack(record)
+                    if seq > self.seq + 1:
+                        break
+                    if seq == self.seq + 1:
+                        self.balances[user_id] = balance
+                        self.dirty.add(user_id)
+                        self.seq = seq
+                        self._stats['recovered_records'] += 1
+                    offset += RECORD_SIZE
+                if offset < len(data):
+                    # Запись оборвалась при сбое - отрезаем хвост, дальше журнал продолжается с неё
+                    f.truncate(offset)
+                    self._stats['truncated_bytes'] += len(data) - offset
+
+    def _open_segment(self, first_seq):
+        if self._journal is not None:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal.close()
+        self._journal = open(os.path.join(self.directory, f'journal-{first_seq:016d}.log'), 'ab')
+        self._unsynced = False
+
+    def _append(self, user_id, amount, balance):
+        self.seq += 1
+        record = RECORD.pack(self.seq, user_id, amount, balance)
+        self._journal.write(record + RECORD_CRC.pack(zlib.crc32(record)))
+        self.balances[user_id] = balance
+        self.dirty.add(user_id)
+        self._stats['records'] += 1
+        if self.fsync_interval:
+            self._unsynced = True
+        else:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._stats['fsyncs'] += 1
+
+    def get(self, user_id):
+        """Balance or None for unknown user"""
+        return self.balances.get(user_id)
+
+    def create(self, user_id, balance):
+        """Open wallet with start balance, returns False if it already exists"""
+        with self._lock:
+            if user_id in self.balances:
+                return False
+            self._append(user_id, balance, balance)
+            return True
+
+    def apply(self, user_id, amount):
+        """Add amount to balance, returns new balance
+        or None for unknown user or if balance would leave 0..max_balance"""
+        with self._lock:
+            balance = self.balances.get(user_id)
+            if balance is None:
+                return None
+            balance += amount
+            if balance < 0 or (self.max_balance is not None and balance > self.max_balance):
+                return None
+            self._append(user_id, amount, balance)
+            return balance
+
+    def reset(self, balances):
+        """Replace whole state (seeding from database) and snapshot it right away"""
+        with self._lock:
+            self.balances = dict(balances)
+            self.dirty = set()
+        self.snapshot()
+
+    def drain_dirty(self):
+        """Changed balances since the last call [(user_id, balance), ...]"""
+        with self._lock:
+            dirty, self.dirty = self.dirty, set()
+            return [(user_id, self.balances[user_id]) for user_id in dirty]
+
+    def mark_dirty(self, user_ids):
+        """Mark balances to be written to database again"""
+        with self._lock:
+            self.dirty.update(user_id for user_id in user_ids if user_id in self.balances)
+
+    def sync(self):
+        """Flush journal to disk"""
+        with self._lock:
+            if self._unsynced:
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                self._unsynced = False
+                self._stats['fsyncs'] += 1
+
+    def snapshot(self):
+        """Write whole state to a new snapshot and drop journal segments it covers
+        Returns snapshot metrics"""
+        with self._snapshot_lock:
+            started = time.perf_counter()
+            with self._lock:
+                # Новый сегмент журнала начинается сразу после снимка
+                seq = self.seq
+                self._open_segment(seq + 1)
+                user_ids = array('q', self.balances.keys())
+                balances = array('q', self.balances.values())
+            copied = time.perf_counter()
+
+            path = os.path.join(self.directory, f'snapshot-{seq:016d}.snap')
+            tmp_path = path + '.tmp'
+            header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, seq, len(user_ids))
+            crc = zlib.crc32(balances, zlib.crc32(user_ids, zlib.crc32(header)))
+            with open(tmp_path, 'wb') as f:
+                f.write(header)
+                user_ids.tofile(f)
+                balances.tofile(f)
+                f.write(RECORD_CRC.pack(crc))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            _fsync_directory(self.directory)
+
+            for snapshot_seq, old_path in self._snapshots():
+                if snapshot_seq < seq:
+                    os.remove(old_path)
+            for first_seq, old_path in self._segments():
+                if first_seq <= seq:
+                    os.remove(old_path)
+
+            self._snapshot_seq = seq
+            self._snapshot_at = time.monotonic()
+            report = {'path': path, 'seq': seq, 'users': len(user_ids), 'bytes': os.path.getsize(path),
+                      'copy_seconds': copied - started, 'seconds': time.perf_counter() - started}
+            self._stats['snapshots'] += 1
+            self._stats['last_snapshot'] = report
+            return report
+
+    def _snapshot_due(self):
+        if self.seq == self._snapshot_seq:
+            return False
+        if self.snapshot_records and self.seq - self._snapshot_seq >= self.snapshot_records:
+            return True
+        return bool(self.snapshot_interval) and time.monotonic() - self._snapshot_at >= self.snapshot_interval
+
+    def _run(self):
+        while not self._stopping.wait(self.fsync_interval or 1):
+            try:
+                self.sync()
+                if self._snapshot_due():
+                    self.snapshot()
+            except OSError as e:
+                print(f"Error in wallet-journal: {e}")
+
+    def stats(self):
+        """Journal, snapshot and recovery counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(seq=self.seq, users=len(self.balances), dirty=len(self.dirty),
+                         journal_records=self.seq - self._snapshot_seq)
+            return stats
+
+    def close(self, snapshot=True):
+        """Stop background thread and fsync journal
+        With snapshot=True the state is snapshotted so the next start replays nothing"""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._thread.join()
+        if snapshot:
+            self.snapshot()
+        self.sync()
+        with self._lock:
+            self._journal.close()
+
+
+def _read_snapshot(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < SNAPSHOT_HEADER.size + RECORD_CRC.size:
+        raise ValueError("snapshot is truncated")
+    magic, _, count = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or len(data) != SNAPSHOT_HEADER.size + count * 16 + RECORD_CRC.size:
+        raise ValueError("not a wallet snapshot")
+    (crc,) = RECORD_CRC.unpack_from(data, len(data) - RECORD_CRC.size)
+    if zlib.crc32(data[:-RECORD_CRC.size]) != crc:
+        raise ValueError("snapshot checksum mismatch")
+    user_ids = array('q')
+    user_ids.frombytes(data[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + count * 8])
+    balances = array('q')
+    balances.frombytes(data[SNAPSHOT_HEADER.size + count * 8:-RECORD_CRC.size])
+    return dict(zip(user_ids, balances))
+
+
+def _fsync_directory(directory):
+    # Переименование файла надёжно только после fsync каталога (на Windows недоступно)
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)